@@ -6,9 +6,15 @@ x----------------------------------------------x
 """
 import wave
 import struct
-import pyaudio
-from datetime import datetime
-import os
+import atexit
+import bisect
+import operator
+from collections import OrderedDict
+from itertools import compress
+import logging
+import queue
+import sys
+import threading
 from time import sleep
 
 ################################################################################ PROGRAM DEFAULTS
@@ -18,10 +24,10 @@ from time import sleep
 # Training sequence time in seconds (0.5-1.0, Default 0.6)
 TRAINING_SEQUENCE_TIME = 0.8
 #
-# Chunk amplitude at which decoding starts (0-32768, Default 18000 [-5.2 dBfs])
-AMPLITUDE_START_THRESHOLD = 18000
+# Chunk amplitude (mean absolute sample) at which decoding starts (0-32768, Default 19000 [-4.7 dBfs])
+AMPLITUDE_START_THRESHOLD = 19000
 #
-# Chunk amplitude at which decoding stops (0-32768, Default 14000 [-7.4 dBfs])
+# Chunk amplitude (mean absolute sample) at which decoding stops (0-32768, Default 14000 [-7.4 dBfs])
 AMPLITUDE_END_THRESHOLD = 14000
 #
 # Amplifier function deadzone (0-32768, Default 128 [-48.2 dBfs])
@@ -29,14 +35,40 @@ AMPLIFIER_DEADZONE = 128
 #
 # Frames per buffer for audio input (1024-4096, Default 2048 [0.043s]) - Smaller blocks increase CPU usage but decrease latency
 INPUT_FRAMES_PER_BLOCK = 2048
+#
+# Decimate received audio to the lowest sample rate each modulation type needs (Default True) - Several times less demodulation work
+RX_DECIMATE = True
+#
+# Symbol timing tracking loop gains (Default 0.2 phase, 0.01 frequency, 0 disables) - Re-aligns symbol boundaries on zero crossings during decoding
+TIMING_PHASE_GAIN = 0.2
+TIMING_FREQUENCY_GAIN = 0.01
+#
+# Largest clock rate error the timing loop will follow (fraction, Default 0.02 [2%])
+TIMING_MAX_DRIFT = 0.02
+#
+# Least reliable bits the soft-decision decoder tries flipping per codeword (0-4, Default 3) - 0 uses hard decisions only
+CHASE_DEPTH = 3
+#
+# How much lower (in summed reliability) a soft-decision candidate's cost must be to override a valid single-bit hard correction (0-1, Default 0.75) - 1 keeps every hard correction
+CHASE_MARGIN = 0.75
+#
+# Frames per buffer for audio output (1024-4096, Default 2048 [0.043s]) - TX audio is rendered and played one block at a time
+OUTPUT_FRAMES_PER_BLOCK = 2048
+#
+# Memory cap for each transmitter's cache of rendered TX audio (bytes, Default 8388608 [8 MiB], 0 disables)
+TX_CACHE_MAX_BYTES = 8 * 1024 * 1024
+#
+# Largest rendered frame kept in the TX audio cache (bytes, Default 1048576 [1 MiB]) - Larger frames are streamed without being kept
+TX_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
 
 # SYSTEM PARAMETERS: DO NOT CHANGE THESE!
 #
 # How many samples per second we are recording (DO NOT CHANGE, sound card resamples if needed)
 SAMPLE_RATE = 48000
 #
-# Wav format (DO NOT CHANGE, sound card handles format conversion if needed)
-FORMAT = pyaudio.paInt16
+# Wav sample width in bytes (DO NOT CHANGE, sound card handles format conversion if needed)
+# The matching PortAudio format is available as FORMAT once PyAudio is loaded.
+SAMPLE_WIDTH = 2
 #
 # Input+output channels (DO NOT CHANGE, sound card handles stereo conversion if needed)
 CHANNELS = 1
@@ -49,50 +81,135 @@ CLOCK_SCAN_WIDTH = 2 * INPUT_FRAMES_PER_BLOCK
 IDEAL_WAVES_DIR = "data/ideal_waves/"
 
 ################################################################################ LOGGING
-def get_date_and_time(): # Long date and time for logging
-        now = datetime.now()
-        return now.strftime('%Y-%m-%d %H:%M:%S')
-
-# Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
-LOG_LEVEL = 0
-#
-# Should the log output to the console?
-LOG_TO_CONSOLE = True
-#
-# Should the log output to a log file?
-LOG_TO_FILE = False
+# Loggers stay silent (apart from Python's last-resort WARNING output) until
+# configure_logging() is called. Callers pass format arguments separately so
+# nothing is formatted unless the level is enabled.
+logger = logging.getLogger("afskmodem")
 #
-# Where to generate logfile if need be
-LOG_PATH = "afskmodem.log"
+# Log line layout and timestamp format
+LOG_FORMAT = "%(asctime)s [%(levelname)-7s] (%(name)s) %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 #
-# How the log identifies which module is logging.
-LOG_PREFIX = "(AFSKmodem)"
-
-# Initialize log file if needed
-if(LOG_TO_FILE):
-    try:
-        os.remove(LOG_PATH)
-    except:
-        pass
-    with open(LOG_PATH, "w") as f:
-        f.write(get_date_and_time() + " [  OK  ] " + LOG_PREFIX + " Logging initialized.\n")
-
-def log(level: int, data: str):
-    if(level >= LOG_LEVEL):
-        output = get_date_and_time()
-        if(level == 0):
-            output += " [  OK  ] "
-        elif(level == 1):
-            output += " [ WARN ] "
-        else:
-            output += " [ERROR!] "
-        output += LOG_PREFIX + " "
-        output += data
-        if(LOG_TO_FILE):
-            with open(LOG_PATH, "a") as f:
-                f.write(output + "\n")
-        if(LOG_TO_CONSOLE):
-            print(output)
+# Maximum number of records written to the log outputs in one batch
+LOG_BATCH_SIZE = 64
+
+class BatchLogHandler(logging.Handler):
+    # Queue-based handler. emit() only enqueues the record; a background thread
+    # formats queued records and writes them to every output in batches.
+    def __init__(self, streams: list, batch_size = LOG_BATCH_SIZE):
+        super().__init__()
+        self.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        self.streams = streams
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target = self.__run, name = "afskmodem-log", daemon = True)
+        self.thread.start()
+
+    # Runs on the caller's thread: just hand the record over
+    def emit(self, record: logging.LogRecord):
+        self.queue.put(record)
+
+    # Drain the queue, writing up to batch_size records per write call
+    def __run(self):
+        running = True
+        while(running):
+            batch = [self.queue.get()]
+            while(len(batch) < self.batch_size):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if(record is None): # Sentinel from close()
+                    running = False
+                    continue
+                try:
+                    lines.append(self.format(record) + "\n")
+                except Exception:
+                    self.handleError(record)
+            if(lines):
+                text = "".join(lines)
+                for stream in self.streams:
+                    try:
+                        stream.write(text)
+                        stream.flush()
+                    except Exception:
+                        pass
+
+    # Write out everything still queued, then close any log files
+    def close(self):
+        if(self.thread.is_alive()):
+            self.queue.put(None)
+            self.thread.join()
+        for stream in self.streams:
+            if(stream not in (sys.stdout, sys.stderr)):
+                stream.close()
+        super().close()
+
+# Handler installed by the last configure_logging() call, and its loggers
+_log_handler = None
+_log_names = ()
+
+# Configure logging for the given loggers (level: a logging level such as
+# logging.INFO, console: write to stdout, path: log file to create, or None).
+# Replaces any configuration made by a previous call.
+def configure_logging(level = logging.WARNING, console = True, path = None, names = ("afskmodem",)):
+    global _log_handler, _log_names
+    if(_log_handler is not None):
+        for name in _log_names:
+            logging.getLogger(name).removeHandler(_log_handler)
+        _log_handler.close()
+        _log_handler = None
+    streams = []
+    if(console):
+        streams.append(sys.stdout)
+    if(path is not None):
+        streams.append(open(path, "w"))
+    if(streams):
+        _log_handler = BatchLogHandler(streams)
+    _log_names = tuple(names)
+    for name in _log_names:
+        target = logging.getLogger(name)
+        target.setLevel(level)
+        if(_log_handler is not None):
+            target.addHandler(_log_handler)
+            target.propagate = False
+    logger.debug("Logging initialized.")
+
+################################################################################ AUDIO DEVICE
+# PyAudio is imported and PortAudio initialized on first use, so importing this
+# module, encoding, decoding and parsing never touch the audio device.
+_pyaudio = None
+_portaudio = None
+
+# Import PyAudio on first use
+def get_pyaudio():
+    global _pyaudio
+    if(_pyaudio is None):
+        import pyaudio
+        _pyaudio = pyaudio
+    return _pyaudio
+
+# Shared PortAudio instance, initialized on first use and terminated at exit
+def get_portaudio():
+    global _portaudio
+    if(_portaudio is None):
+        _portaudio = get_pyaudio().PyAudio()
+        atexit.register(_terminate_portaudio)
+    return _portaudio
+
+def _terminate_portaudio():
+    global _portaudio
+    if(_portaudio is not None):
+        _portaudio.terminate()
+        _portaudio = None
+
+# Resolve FORMAT lazily so that it does not import PyAudio with the module
+def __getattr__(name: str):
+    if(name == "FORMAT"):
+        return get_pyaudio().get_format_from_width(SAMPLE_WIDTH)
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 ################################################################################ DIGITAL MODULATION TYPES
 class DigitalModulationTypes:
@@ -124,6 +241,37 @@ class DigitalModulationTypes:
         else: # default
             return int(SAMPLE_RATE / 1200)
 
+    # Symbols per second
+    def get_baud_rate(digital_modulation_type: str) -> int:
+        if(digital_modulation_type == "afsk300"):
+            return 300
+        elif(digital_modulation_type == "afsk600"):
+            return 600
+        elif(digital_modulation_type == "afsk1200"):
+            return 1200
+        elif(digital_modulation_type == "afsk2400"):
+            return 2400
+        elif(digital_modulation_type == "afsk6000"):
+            return 6000
+        else: # default
+            return 1200
+
+    # Factor by which received audio can be decimated: down to 5 samples per
+    # mark tone cycle (10 samples per bit), e.g. 12 kHz for afsk1200
+    def get_decimation_factor(digital_modulation_type: str) -> int:
+        if(digital_modulation_type == "afsk300"):
+            return 16
+        elif(digital_modulation_type == "afsk600"):
+            return 8
+        elif(digital_modulation_type == "afsk1200"):
+            return 4
+        elif(digital_modulation_type == "afsk2400"):
+            return 2
+        elif(digital_modulation_type == "afsk6000"):
+            return 1
+        else: # default
+            return 4
+
     # Training sequence oscillations for specified time
     def get_ts_oscillations(sequence_time: int, digital_modulation_type: str) -> int:
         if(digital_modulation_type == "afsk300"):
@@ -171,24 +319,24 @@ class DigitalModulationTypes:
 
 ################################################################################ IDEAL WAVES
 class IdealWaves: # Ideal waves for TX and RX
+    # Raw frames of every wav file loaded so far, shared by all instances
+    raw_wav_cache = {}
+
     def __init__(self, digital_modulation_type = DigitalModulationTypes.default()):
         self.digital_modulation_type = digital_modulation_type
 
     # Load wav data to int array
     def __load_wav_data(self, filename: str) -> list:
-        with wave.open(filename, "r") as f:
-            nFrames = f.getnframes()
-            expFrames = []
-            for i in range(0, nFrames):
-                sFrame = f.readframes(1)
-                expFrames.append(struct.unpack("<h", sFrame)[0])
-            return expFrames
-
-    # Load wav data to bytes
+        frames = self.__load_raw_wav_data(filename)
+        return list(struct.unpack("<" + str(len(frames) // 2) + "h", frames))
+
+    # Load wav data to bytes (each file is only read once)
     def __load_raw_wav_data(self, filename: str) -> bytes:
-        with wave.open(filename, "r") as f:
-            nFrames = f.getnframes()
-            return f.readframes(nFrames)
+        if(filename not in IdealWaves.raw_wav_cache):
+            with wave.open(filename, "r") as f:
+                nFrames = f.getnframes()
+                IdealWaves.raw_wav_cache[filename] = f.readframes(nFrames)
+        return IdealWaves.raw_wav_cache[filename]
     
     # Silence (20ms) to pad output with for TX
     def get_tx_silence(self) -> bytes: 
@@ -218,18 +366,26 @@ class IdealWaves: # Ideal waves for TX and RX
 class Hamming:
     # Each instance of Hamming keeps track of the errors it corrects. 
     # An instance of Hamming is created for each DigitalTransmitter or DigitalReceiver instance.
-    def __init__(self): 
+    def __init__(self, chase_depth = CHASE_DEPTH, chase_margin = CHASE_MARGIN): 
         self.r = 4
+        self.chase_depth = chase_depth
+        self.chase_margin = chase_margin
         self.error_count = 0
+        self.bit_error_count = 0
 
-    def reset_error_count(self): # Reset error count to 0
+    def reset_error_count(self): # Reset error counts to 0
         self.error_count = 0
+        self.bit_error_count = 0
     
-    def get_error_count(self) -> int: # Get error count
+    def get_error_count(self) -> int: # Get error count (corrected codewords)
         return self.error_count
+
+    def get_bit_error_count(self) -> int: # Get the number of bits flipped by correction
+        return self.bit_error_count
     
     def __increment_error_count(self): # Increment error count
         self.error_count += 1
+        self.bit_error_count += 1
     
     # Pad the positions of parity bits with 0
     def __pad_parity_bits(self, data: str) -> str:
@@ -310,26 +466,115 @@ class Hamming:
         output_data = self.__trim_parity_bits(corrected_data)
         return(output_data)
 
+    # Flip the bits at the given positions
+    def __flip_bits(self, data: str, positions) -> str:
+        data_list = list(data)
+        for i in positions:
+            if(data_list[i] == "0"):
+                data_list[i] = "1"
+            else:
+                data_list[i] = "0"
+        return "".join(data_list)
+
+    # Chase-II decoding: flip every combination of the chase_depth least
+    # reliable bits, hard-decode each candidate and keep the valid codeword
+    # whose changed bits have the lowest total reliability. Reliabilities are
+    # only a rough guide, so a valid single-bit hard correction is kept unless
+    # a candidate costs at least chase_margin less.
+    def __chase_correct(self, data: str, reliability: list) -> str:
+        n = len(data)
+        least_reliable = sorted(range(n), key = lambda i: reliability[i])[:self.chase_depth]
+        best_data = None
+        best_cost = 0
+        hard_data = None
+        hard_cost = 0
+        for pattern in range(1 << len(least_reliable)):
+            test_data = self.__flip_bits(data, [least_reliable[b] for b in range(len(least_reliable)) if pattern >> b & 1])
+            error_pos = self.__get_error_index(test_data)
+            if(error_pos < 0): # Syndrome points outside the codeword, not correctable
+                continue
+            if(error_pos < n):
+                test_data = self.__flip_bits(test_data, [error_pos])
+            cost = 0
+            for i in range(n):
+                if(test_data[i] != data[i]):
+                    cost += reliability[i]
+            if(pattern == 0): # No bits flipped: the hard-decision correction
+                hard_data = test_data
+                hard_cost = cost
+            if(best_data is None or cost < best_cost):
+                best_data = test_data
+                best_cost = cost
+        if(best_data is None): # Nothing decoded, leave the bits as received
+            return data
+        if(hard_data is not None and best_cost + self.chase_margin > hard_cost):
+            return hard_data
+        return best_data
+
+    # Soft-decision decode: like decode(), but uses per-bit reliabilities
+    # (0: a guess, 1: certain) to choose which bits to correct.
+    def decode_soft(self, data: str, reliability: list) -> str:
+        if(self.chase_depth <= 0):
+            return self.decode(data)
+        if(self.__get_error_index(data) == len(data)): # Already a valid codeword
+            return self.__trim_parity_bits(data)
+        corrected_data = self.__chase_correct(data, reliability)
+        flipped = 0
+        for i in range(len(data)):
+            if(corrected_data[i] != data[i]):
+                flipped += 1
+        if(flipped > 0):
+            self.error_count += 1
+            self.bit_error_count += flipped
+        return self.__trim_parity_bits(corrected_data)
+
 ################################################################################ RX TOOLS
 class DigitalReceiver:
     def __init__(self,
     digital_modulation_type = DigitalModulationTypes.default(),    
     amp_start_threshold = AMPLITUDE_START_THRESHOLD,
     amp_end_threshold = AMPLITUDE_END_THRESHOLD,
-    amp_deadzone = AMPLIFIER_DEADZONE):
+    amp_deadzone = AMPLIFIER_DEADZONE,
+    decimate = RX_DECIMATE):
         self.digital_modulation_type = digital_modulation_type
         self.amp_start_threshold = amp_start_threshold
         self.amp_end_threshold = amp_end_threshold
         self.amp_deadzone = amp_deadzone
-        self.unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type)
+        # Demodulation runs at SAMPLE_RATE / decimation, recording at SAMPLE_RATE
+        self.decimation = 1
+        if(decimate):
+            self.decimation = DigitalModulationTypes.get_decimation_factor(self.digital_modulation_type)
+        self.rx_sample_rate = SAMPLE_RATE // self.decimation
+        self.clock_scan_width = CLOCK_SCAN_WIDTH // self.decimation
+        self.unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type) // self.decimation
+        # Exact (fractional) symbol period in samples, used by the timing loop
+        self.symbol_time = self.rx_sample_rate / DigitalModulationTypes.get_baud_rate(self.digital_modulation_type)
         self.space_tone = DigitalModulationTypes.get_space_tone(self.digital_modulation_type)
         self.mark_tone = DigitalModulationTypes.get_mark_tone(self.digital_modulation_type)
-        ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
-        self.rx_space = ideal_waves.get_rx_space()
-        self.rx_mark = ideal_waves.get_rx_mark()
-        self.rx_training = ideal_waves.get_rx_training()
+        self.rx_space = None # Ideal waves are loaded on first decode
+        self.rx_mark = None
+        self.rx_training = None
         self.ecc = Hamming()
-    
+        self.bit_count = 0 # Statistics of the last decode, see get_integrity()
+        self.bit_error_count = 0
+        self.mean_reliability = 1
+        self.last_recording = b"" # Audio captured by the last rx()
+
+    # Load the ideal waves if this is the first decode
+    def __load_ideal_waves(self):
+        if(self.rx_training is None):
+            ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
+            self.rx_space = self.__decimate(ideal_waves.get_rx_space())
+            self.rx_mark = self.__decimate(ideal_waves.get_rx_mark())
+            self.rx_training = self.rx_mark + self.rx_space
+
+    # Low-pass filter (boxcar average) and decimate audio to rx_sample_rate
+    def __decimate(self, frames) -> list:
+        d = self.decimation
+        if(d == 1):
+            return list(frames)
+        return [s // d for s in map(sum, zip(*[iter(frames)] * d))]
+
     # Load raw wav data from file
     def __load_raw_wav_data(self, filename: str) -> bytes:
         with wave.open(filename, "r") as f:
@@ -338,30 +583,20 @@ class DigitalReceiver:
     
     # From sine to square
     def __amplify_chunk(self, chunk: list) -> list:
-        amp_chunk = []
-        for i in chunk:
-            if(i > self.amp_deadzone):
-                amp_chunk.append(32767)
-            elif(i < -1 * self.amp_deadzone):
-                amp_chunk.append(-32767)
-            else:
-                amp_chunk.append(0)
-        return amp_chunk
+        deadzone = self.amp_deadzone
+        return [32767 if i > deadzone else (-32767 if i < -deadzone else 0) for i in chunk]
 
-    # Average deviation from bytes
+    # Average deviation (mean absolute sample) of a block of 16-bit frames
     def __avg_deviation_bytes(self, frames: bytes) -> int:
-        s_frames = []
-        for i in range(len(frames) - 1): 
-            s_frame = frames[i:i+2]
-            s_frames.append(abs(struct.unpack("<h", s_frame)[0]))
-            i += 2
-        return int(sum(s_frames) / len(s_frames))
+        n_frames = len(frames) // 2
+        s_frames = struct.unpack("<" + str(n_frames) + "h", frames[:n_frames * 2])
+        return int(sum(map(abs, s_frames)) / n_frames)
 
     # Auto-record and return frames
     def __auto_record(self, timeout_seconds=-1) -> bytes:
         timeout_iters = round(timeout_seconds * (SAMPLE_RATE/INPUT_FRAMES_PER_BLOCK))
-        pa = pyaudio.PyAudio() # Open an input stream with PortAudio
-        stream = pa.open(format=FORMAT, channels=CHANNELS,
+        pa = get_portaudio() # Open an input stream with PortAudio
+        stream = pa.open(format=pa.get_format_from_width(SAMPLE_WIDTH), channels=CHANNELS,
                 rate=SAMPLE_RATE, input=True,
                 frames_per_buffer=INPUT_FRAMES_PER_BLOCK)
         stream.read(INPUT_FRAMES_PER_BLOCK) # Flush input buffer
@@ -372,7 +607,6 @@ class DigitalReceiver:
                 # Close stream and return nothing if timeout is reached
                 stream.stop_stream()
                 stream.close()
-                pa.terminate()
                 return b''
             
             recorded_frames = []
@@ -385,27 +619,20 @@ class DigitalReceiver:
                     chunk_amplitude = self.__avg_deviation_bytes(block_frames)
                 stream.stop_stream()
                 stream.close()
-                pa.terminate()
                 return b''.join(recorded_frames)
 
     # Unsigned average deviation from audio stored as ints
     def __avg_deviation_array(self, chunk: list) -> int: 
-        frame_sum = 0
-        for frame in chunk:
-            frame_sum += abs(frame)
-        return int(frame_sum / len(chunk))
+        return int(sum(map(abs, chunk)) / len(chunk))
 
     # Find the difference between an ideal wave and a received wave
     def __compare_samples(self, ideal_sample: list, given_sample: list) -> int: 
-        differences = []
-        for i in range(len(ideal_sample)):
-            differences.append(abs(ideal_sample[i] - given_sample[i]))
-        return int(sum(differences) / len(differences))
+        return int(sum(map(abs, map(operator.sub, ideal_sample, given_sample))) / len(ideal_sample))
 
     # Recover the clock from a chunk of audio by scanning the training sequence
     def __recover_clock_index(self, chunk: list) -> int:
         try:
-            fit_chunk = self.__amplify_chunk(chunk[0:CLOCK_SCAN_WIDTH]) 
+            fit_chunk = self.__amplify_chunk(chunk[0:self.clock_scan_width]) 
             fit_devs = []
             # Create an array of deviations
             for i in range(len(fit_chunk) - self.unit_time * 2 - 1): 
@@ -418,50 +645,112 @@ class DigitalReceiver:
             # Catch most often an out-of-bounds exception indicating not enough good data
             return -1
 
-    # Check if a chunk's value is 1 or 0 based on its similarity to ideal waves.
-    def __get_bit_value(self, chunk: list) -> str:
-        # Amplify received wave to approximate to a square wave
-        decChunk = self.__amplify_chunk(chunk)
+    # Check if a chunk's value is 1 or 0 based on its similarity to ideal waves,
+    # and how reliable that decision is (0: a guess, 1: certain). The chunk must
+    # already be amplified.
+    def __get_soft_bit_value(self, amp_chunk: list):
         # Compare to ideal square waves
-        markDiff = self.__compare_samples(self.rx_mark, decChunk)
-        spaceDiff = self.__compare_samples(self.rx_space, decChunk)
+        markDiff = self.__compare_samples(self.rx_mark, amp_chunk)
+        spaceDiff = self.__compare_samples(self.rx_space, amp_chunk)
+        total = markDiff + spaceDiff
+        if(total == 0):
+            reliability = 0
+        else:
+            reliability = abs(spaceDiff - markDiff) / total
         if(markDiff < spaceDiff):
-            return "1"
+            return "1", reliability
         else:
-            return "0"
-
-    # Get bits from wav data
-    def __get_bits_from_wav_data(self, frames: bytes) -> str:
-            exp_frames = []
-            bits = ""
-            frame_iter = 0
-            # Unpack bytes data to array of amplitudes
-            while(frame_iter < len(frames) - 1): 
-                s_frame = frames[frame_iter:frame_iter+2]
-                exp_frames.append(struct.unpack("<h", s_frame)[0])
-                frame_iter += 2
+            return "0", reliability
+
+    # Get bits and their reliabilities from wav data. The whole capture is
+    # unpacked, amplified and scanned for zero crossings in one pass before
+    # the symbols are compared.
+    def __get_soft_bits_from_wav_data(self, frames: bytes):
+            # Unpack bytes data to array of amplitudes, then decimate
+            raw_frames = struct.unpack("<" + str(len(frames) // 2) + "h", frames[:len(frames) // 2 * 2])
+            exp_frames = self.__decimate(raw_frames)
+            d = self.decimation
             nFrames = len(exp_frames)
+            bits = []
+            reliabilities = []
 
             # Recover the clock
             start_sample = self.__recover_clock_index(exp_frames) 
             
             # If no start sample could be found we can't decode
             if(start_sample == -1): 
-                return ""
+                return "", []
             
             # Decode to bits (including training block, we'll trim it off later)
-            chunk_iter = int(self.unit_time) + start_sample 
-            while(chunk_iter < nFrames - 1):
-                chunk = exp_frames[int(chunk_iter - self.unit_time):int(chunk_iter)]
-                # End decode when no more data is being transmitted
-                if(self.__avg_deviation_array(chunk) < self.amp_end_threshold): 
+            amp_frames = self.__amplify_chunk(exp_frames)
+            crossings = self.__find_rising_crossings(exp_frames)
+            symbol_start = float(start_sample)
+            period = self.symbol_time
+            min_period = self.symbol_time * (1 - TIMING_MAX_DRIFT)
+            max_period = self.symbol_time * (1 + TIMING_MAX_DRIFT)
+            while(True):
+                chunk_start = int(symbol_start)
+                chunk_end = chunk_start + self.unit_time
+                if(chunk_end >= nFrames - 1):
+                    break
+                # End decode when no more data is being transmitted. Checked on
+                # the full-rate audio as in __auto_record: the thresholds are set
+                # for 48 kHz, and decimation lowers the deviation. Decimated
+                # samples never deviate more than the audio they average, so the
+                # full-rate check is only needed when the decimated one fails.
+                if(self.__avg_deviation_array(exp_frames[chunk_start:chunk_end]) <= self.amp_end_threshold
+                    and self.__avg_deviation_array(raw_frames[chunk_start * d:chunk_end * d]) < self.amp_end_threshold): 
                     break
-                bits += self.__get_bit_value(chunk)
-                chunk_iter += self.unit_time
-            return bits
+                chunk = self.__get_symbol_chunk(exp_frames, amp_frames, chunk_start, symbol_start - chunk_start)
+                bit, reliability = self.__get_soft_bit_value(chunk)
+                bits.append(bit)
+                reliabilities.append(reliability)
+                # Timing loop: every symbol starts on a rising zero crossing, so
+                # steer the next boundary towards the one observed near it.
+                symbol_start += period
+                error = self.__get_timing_error(crossings, symbol_start)
+                if(error != 0):
+                    symbol_start += TIMING_PHASE_GAIN * error
+                    period = min(max(period + TIMING_FREQUENCY_GAIN * error, min_period), max_period)
+            return "".join(bits), reliabilities
+
+    # One amplified symbol of audio starting frac (0-1) samples after
+    # frames[start]. Symbols within a quarter sample of a whole sample are
+    # sliced from the pre-amplified frames; only those near half a sample off
+    # are linearly interpolated between neighbouring samples.
+    def __get_symbol_chunk(self, frames: list, amp_frames: list, start: int, frac: float) -> list:
+        if(frac < 0.25):
+            return amp_frames[start:start + self.unit_time]
+        if(frac > 0.75):
+            return amp_frames[start + 1:start + 1 + self.unit_time]
+        end = start + self.unit_time
+        return self.__amplify_chunk([a + (b - a) * frac for a, b in zip(frames[start:end], frames[start+1:end+1])])
+
+    # Positions (in fractional samples, ascending) of every rising zero
+    # crossing, interpolated between the samples either side. Sample k covers
+    # [k, k+1), so its value belongs at k + 0.5.
+    def __find_rising_crossings(self, frames: list) -> list:
+        negative = [v < 0 for v in frames]
+        rising = compress(range(len(frames) - 1), map(operator.gt, negative, negative[1:]))
+        return [k + 0.5 - frames[k] / (frames[k + 1] - frames[k]) for k in rising]
+
+    # Offset (in fractional samples) from an expected symbol boundary to the
+    # nearest rising zero crossing within a quarter symbol of it, or 0 if there
+    # is none.
+    def __get_timing_error(self, crossings: list, boundary: float) -> float:
+        window = self.symbol_time / 4
+        i = bisect.bisect_left(crossings, boundary)
+        best = window
+        if(i < len(crossings)):
+            best = crossings[i] - boundary
+        if(i > 0 and boundary - crossings[i - 1] < abs(best)):
+            best = crossings[i - 1] - boundary
+        if(abs(best) < window):
+            return best
+        return 0.0
 
-    # Trim the training block off of received bits
-    def __trim_training_block(self, data: str) -> str:
+    # Find the index of the first bit after the training block
+    def __find_training_end(self, data: str) -> int:
         training_bits = 0
         zero_count = 0
         end_training_index = 0
@@ -475,7 +764,7 @@ class DigitalReceiver:
                     break
             else:
                 zero_count = 0
-        return(data[end_training_index::])
+        return end_training_index
 
     # Convert bits to bytes
     def __get_bytes_from_bits(self, b_data: str) -> bytes:
@@ -486,72 +775,195 @@ class DigitalReceiver:
             i += 8
         return bytes(int_data)
     
-    # Run error correction and remove all parity bits from bits data
-    def __get_data_from_ecc(self, data: str) -> str:
-        data_bytes = []
+    # Run soft-decision error correction and remove all parity bits from bits data
+    def __get_data_from_ecc(self, data: str, reliabilities: list) -> str:
         decoded_bytes = []
         data_iter = 0
         self.ecc.reset_error_count()
         while(data_iter < len(data) - 11):
-            data_bytes.append(data[data_iter:data_iter+12])
+            decoded_bytes.append(self.ecc.decode_soft(data[data_iter:data_iter+12], reliabilities[data_iter:data_iter+12]))
             data_iter += 12
-        for dataByte in data_bytes:
-            decoded_bytes.append(self.ecc.decode(dataByte))
         output = "".join(decoded_bytes)
+        self.bit_count = data_iter
+        self.bit_error_count = self.ecc.get_bit_error_count()
+        if(data_iter > 0):
+            self.mean_reliability = sum(reliabilities[0:data_iter]) / data_iter
         return output, self.ecc.get_error_count()
-    
+
+    # Decode bytes data and the corrected error count from recorded wav data
+    def decode(self, wav_data: bytes):
+        self.__load_ideal_waves()
+        self.bit_count = 0
+        self.bit_error_count = 0
+        self.mean_reliability = 1
+        bd, reliabilities = self.__get_soft_bits_from_wav_data(wav_data)
+        if(bd == ""): # if no good data
+            logger.warning("Receiver - bad packet.")
+            return b"", 0
+        training_end = self.__find_training_end(bd)
+        decoded_bin, error_count = self.__get_data_from_ecc(bd[training_end:], reliabilities[training_end:])
+        return self.__get_bytes_from_bits(decoded_bin), error_count
+
+    # Bit-level integrity of the last decode: the fraction of received code
+    # bits that did not need correcting (1.0 if nothing was decoded).
+    def get_integrity(self) -> float:
+        if(self.bit_count == 0):
+            return 1.0
+        return 1 - (self.bit_error_count / self.bit_count)
+
+    # Mean demodulator reliability of the last decode's code bits (0-1)
+    def get_mean_reliability(self) -> float:
+        return self.mean_reliability
+
+    # Decode bytes data and the corrected error count from a wav file
+    def decode_file(self, filename: str):
+        return self.decode(self.__load_raw_wav_data(filename))
+
     # One call to receive bytes data from default audio input (timeout in seconds, disabled by default)
     def rx(self, timeout=-1):
-        log(0, "Receiver - listening...")
+        logger.info("Receiver - listening...")
         wav_data = self.__auto_record(timeout)
+        self.last_recording = wav_data
         if(wav_data == b""): # if timed out
-            log(1, "Receiver - timed out.")
-            return b"", 0
-        bd = self.__get_bits_from_wav_data(wav_data)
-        if(bd == ""): # if no good data
-            log(1, "Receiver - bad packet.")
+            logger.debug("Receiver - timed out.")
             return b"", 0
-        bd = self.__trim_training_block(bd)
-        decoded_bin, error_count = self.__get_data_from_ecc(bd)
-        bytes_data = self.__get_bytes_from_bits(decoded_bin)
-        log(0, "Receiver - done.")
+        bytes_data, error_count = self.decode(wav_data)
+        if(bytes_data != b""):
+            logger.info("Receiver - done.")
         return bytes_data, error_count
 
+    # Carrier sense: listen for sense_blocks input blocks and return TRUE if
+    # any of them is as loud as an ongoing transmission (amp_end_threshold).
+    def channel_busy(self, sense_blocks = 1) -> bool:
+        pa = get_portaudio() # Open an input stream with PortAudio
+        stream = pa.open(format=pa.get_format_from_width(SAMPLE_WIDTH), channels=CHANNELS,
+                rate=SAMPLE_RATE, input=True,
+                frames_per_buffer=INPUT_FRAMES_PER_BLOCK)
+        busy = False
+        for i in range(sense_blocks):
+            block_frames = stream.read(INPUT_FRAMES_PER_BLOCK)
+            if(self.__avg_deviation_bytes(block_frames) > self.amp_end_threshold):
+                busy = True
+                break
+        stream.stop_stream()
+        stream.close()
+        return busy
+
+    # Audio captured by the last rx() (b"" if it timed out)
+    def get_last_recording(self) -> bytes:
+        return self.last_recording
+
 ################################################################################ TX TOOLS
+class TXAudioCache:
+    # Bounded LRU cache of rendered TX audio, keyed by the frame bytes and the
+    # modulation type (plus training length) it was rendered with. Entries are
+    # evicted least recently used first once the memory cap is exceeded.
+    # A cache may be shared between several DigitalTransmitter instances.
+    def __init__(self, max_bytes = TX_CACHE_MAX_BYTES, max_entry_bytes = TX_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Memory held by one entry
+    def __entry_size(self, key: tuple, wav_data: bytes) -> int:
+        return len(key[2]) + len(wav_data)
+
+    def __remove(self, key: tuple):
+        self.size -= self.__entry_size(key, self.entries.pop(key))
+
+    # Return the rendered audio for a frame, or None if it is not cached
+    def get(self, data: bytes, digital_modulation_type: str, ts_oscillations: int):
+        key = (digital_modulation_type, ts_oscillations, bytes(data))
+        wav_data = self.entries.get(key)
+        if(wav_data is None):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return wav_data
+
+    # Check whether rendered audio of the given size (for a frame of data_size
+    # bytes, which is stored as the key) would be stored
+    def fits(self, wav_size: int, data_size = 0) -> bool:
+        return wav_size <= self.max_entry_bytes and data_size + wav_size <= self.max_bytes
+
+    # Store the rendered audio for a frame, evicting old entries as needed.
+    # Audio larger than max_entry_bytes (or entries that would not fit in the
+    # cache at all) is not stored.
+    def put(self, data: bytes, digital_modulation_type: str, ts_oscillations: int, wav_data: bytes):
+        key = (digital_modulation_type, ts_oscillations, bytes(data))
+        if(not self.fits(len(wav_data), len(key[2]))):
+            return
+        entry_size = self.__entry_size(key, wav_data)
+        if(key in self.entries):
+            self.__remove(key)
+        while(self.size + entry_size > self.max_bytes):
+            self.__remove(next(iter(self.entries)))
+        self.entries[key] = wav_data
+        self.size += entry_size
+
+    # Drop cached audio. With no arguments the whole cache is cleared, otherwise
+    # only entries matching the given frame and/or modulation type are dropped.
+    # Returns the number of entries removed.
+    def invalidate(self, data = None, digital_modulation_type = None) -> int:
+        if(data is None and digital_modulation_type is None):
+            removed = len(self.entries)
+            self.entries.clear()
+            self.size = 0
+            return removed
+        stale = [key for key in self.entries
+            if (data is None or key[2] == data)
+            and (digital_modulation_type is None or key[0] == digital_modulation_type)]
+        for key in stale:
+            self.__remove(key)
+        return len(stale)
+
+    def get_hits(self) -> int: # Number of lookups served from the cache
+        return self.hits
+
+    def get_misses(self) -> int: # Number of lookups that had to render
+        return self.misses
+
+    def get_size(self) -> int: # Memory currently held by the cache in bytes
+        return self.size
+
+    def get_entry_count(self) -> int: # Number of cached frames
+        return len(self.entries)
+
+    def reset_stats(self): # Reset hit/miss counters to 0
+        self.hits = 0
+        self.misses = 0
+
 class DigitalTransmitter:
     def __init__(self, 
     digital_modulation_type = DigitalModulationTypes.default(),
-    training_sequence_time = TRAINING_SEQUENCE_TIME):
+    training_sequence_time = TRAINING_SEQUENCE_TIME,
+    tx_cache = None):
         self.digital_modulation_type = digital_modulation_type
         self.ts_oscillations = DigitalModulationTypes.get_ts_oscillations(training_sequence_time, self.digital_modulation_type)
         self.unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type)
-        ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
-        self.tx_space = ideal_waves.get_tx_space()
-        self.tx_mark = ideal_waves.get_tx_mark()
-        self.tx_silence = ideal_waves.get_tx_silence()
+        self.tx_space = None # Ideal waves are loaded on first encode
+        self.tx_mark = None
+        self.tx_silence = None
         self.ecc = Hamming()
+        if(tx_cache is None): # Each transmitter gets its own cache unless one is shared
+            tx_cache = TXAudioCache()
+        self.tx_cache = tx_cache
 
-    # Get bits from bytes
-    def __get_bits_from_bytes(self, b_in: bytes) -> str:
-        bits = ""
-        for i in range(len(b_in)):
-            bits += '{0:08b}'.format(b_in[i])
-        return bits
-
-    # Encode bits to audio
-    def __encode(self, bits: str) -> bytes:
-        out_frames = []
-        # Pad the start of the file with silence
-        out_frames += self.tx_silence
-        # Write the data freqs to the file
-        for bit in bits:
-            if(bit == "0"):
-                out_frames += self.tx_space
-            else:
-                out_frames += self.tx_mark
-        # Pad the end of the file with silence
-        out_frames += self.tx_silence
-        return bytes(out_frames)
+    # Load the ideal waves if this is the first encode
+    def __load_ideal_waves(self):
+        if(self.tx_silence is None):
+            ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
+            self.tx_space = ideal_waves.get_tx_space()
+            self.tx_mark = ideal_waves.get_tx_mark()
+            self.tx_silence = ideal_waves.get_tx_silence()
+
+    # Get the bits of one byte
+    def __get_bits_from_byte(self, b_in: int) -> str:
+        return '{0:08b}'.format(b_in)
 
     # Generate training block
     def __make_training_block(self) -> str:
@@ -560,45 +972,96 @@ class DigitalTransmitter:
         output += "0" * 3
         return output
 
-    # Generate and insert ECC into the data.
-    def __insert_ecc(self, data: str) -> str:
-        data_bytes = []
-        encoded_bytes = []
-        dataIter = 0
-        while(dataIter < len(data) - 7):
-            data_bytes.append(data[dataIter:dataIter+8])
-            dataIter += 8
-        for dataByte in data_bytes:
-            encoded_bytes.append(self.ecc.encode(dataByte))
-        output = "".join(encoded_bytes)
-        return(output)
-
-    # Play a sound from wav data
-    def __play_wav_data(self, data: bytes):
+    # Yield the bits to transmit: the training block, then each byte of data
+    # with ECC inserted, one codeword at a time.
+    def __iter_tx_bits(self, data: bytes):
+        yield self.__make_training_block()
+        for b in data:
+            yield self.ecc.encode(self.__get_bits_from_byte(b))
+
+    # Size in bytes of the wav data rendered for data_length bytes of data
+    def __get_rendered_size(self, data_length: int) -> int:
+        n_bits = self.ts_oscillations * 2 + 4 + data_length * 12
+        return 2 * len(self.tx_silence) + n_bits * len(self.tx_mark)
+
+    # Encode bits to audio, yielding chunks of frames_per_chunk frames (the last
+    # chunk may be shorter). Only one chunk is held in memory at a time.
+    def __iter_encode(self, data: bytes, frames_per_chunk: int):
+        chunk_size = frames_per_chunk * SAMPLE_WIDTH * CHANNELS
+        out_frames = bytearray()
+        # Pad the start with silence
+        out_frames += self.tx_silence
+        # Write the data freqs
+        for bits in self.__iter_tx_bits(data):
+            for bit in bits:
+                if(bit == "0"):
+                    out_frames += self.tx_space
+                else:
+                    out_frames += self.tx_mark
+            while(len(out_frames) >= chunk_size):
+                yield bytes(out_frames[:chunk_size])
+                del out_frames[:chunk_size]
+        # Pad the end with silence
+        out_frames += self.tx_silence
+        while(len(out_frames) > 0):
+            yield bytes(out_frames[:chunk_size])
+            del out_frames[:chunk_size]
+
+    # Split already rendered wav data into chunks without copying it
+    def __iter_chunks(self, wav_data: bytes, frames_per_chunk: int):
+        chunk_size = frames_per_chunk * SAMPLE_WIDTH * CHANNELS
+        view = memoryview(wav_data)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i+chunk_size]
+
+    # Play a sound from chunks of wav data, writing each chunk as it is produced
+    def __play_wav_data(self, chunks):
             # Open an output stream with PortAudio
-            pa = pyaudio.PyAudio()
+            pa = get_portaudio()
             stream = pa.open(
-                format = FORMAT,
+                format = pa.get_format_from_width(SAMPLE_WIDTH),
                 channels = CHANNELS,
                 rate = SAMPLE_RATE,
-                output = True
+                output = True,
+                frames_per_buffer = OUTPUT_FRAMES_PER_BLOCK
             )
-            # Write data to the stream
-            stream.write(data)
-            sleep(0.1) # let the stream finish
-            stream.close()
-            stream.stop_stream()
-            pa.terminate()
+            # Write data to the stream, closing it even if rendering fails
+            try:
+                for chunk in chunks:
+                    stream.write(bytes(chunk))
+                sleep(0.1) # let the stream finish
+            finally:
+                stream.stop_stream()
+                stream.close()
+
+    # Render bytes data to chunks of wav data (frames_per_chunk frames each).
+    # Cached frames are served from the cache; frames small enough to be cached
+    # are added to it once fully rendered, larger ones are never held whole.
+    def iter_encode(self, data: bytes, frames_per_chunk = OUTPUT_FRAMES_PER_BLOCK):
+        wav_data = self.tx_cache.get(data, self.digital_modulation_type, self.ts_oscillations)
+        if(wav_data is not None): # Repeated frame, no encoding work needed
+            yield from self.__iter_chunks(wav_data, frames_per_chunk)
+            return
+        self.__load_ideal_waves()
+        if(not self.tx_cache.fits(self.__get_rendered_size(len(data)), len(data))):
+            yield from self.__iter_encode(data, frames_per_chunk)
+            return
+        rendered = []
+        for chunk in self.__iter_encode(data, frames_per_chunk):
+            rendered.append(chunk)
+            yield chunk
+        self.tx_cache.put(data, self.digital_modulation_type, self.ts_oscillations, b"".join(rendered))
+
+    def encode(self, data: bytes) -> bytes: # Render bytes data to wav data without playing it
+        return b"".join(self.iter_encode(data))
+
+    def get_tx_cache(self) -> TXAudioCache: # Return the cache of rendered TX audio
+        return self.tx_cache
 
     def tx(self, data: bytes): # One call to send bytes data over default audio output
-        log(0, "Transmitter - sending " + str(len(data)) + " bytes...")
-        message_bits = self.__get_bits_from_bytes(data)
-        ecc_bits = self.__insert_ecc(message_bits)
-        training_block = self.__make_training_block()
-        tx_bits = training_block + ecc_bits
-        out_frames = self.__encode(tx_bits)
-        self.__play_wav_data(out_frames)
-        log(0, "Transmitter - done.")
+        logger.info("Transmitter - sending %d bytes...", len(data))
+        self.__play_wav_data(self.iter_encode(data))
+        logger.info("Transmitter - done.")
     
     def est_tx_time(self, data_length: int): # Estimate transmission time in seconds
         return (self.ts_oscillations * 2 + data_length * 12) / (SAMPLE_RATE / self.unit_time)
@@ -1,6 +1,10 @@
 import afskmodem
-import os
-from datetime import datetime
+import hashlib
+import heapq
+import logging
+import random
+import time
+from collections import OrderedDict
 """
 x-----------------------------------------------------------x
 | AP1200 - A simple, reliable amateur packet radio protocol |
@@ -8,50 +12,14 @@ x-----------------------------------------------------------x
 x-----------------------------------------------------------x
 """
 ################################################################################ LOGGING
-def get_date_and_time(): # Long date and time for logging
-        now = datetime.now()
-        return now.strftime('%Y-%m-%d %H:%M:%S')
+# Logger for this module, see afskmodem.configure_logging() for the handler
+logger = logging.getLogger("ap1200")
 
-# Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
-LOG_LEVEL = 0
-#
-# Should the log output to the console?
-LOG_TO_CONSOLE = True
-#
-# Should the log output to a log file?
-LOG_TO_FILE = False
-#
-# Where to generate logfile if need be
-LOG_PATH = "ap1200.log"
-#
-# How the log identifies which module is logging.
-LOG_PREFIX = "(AP1200)"
-
-# Initialize log file if needed
-if(LOG_TO_FILE):
-    try:
-        os.remove(LOG_PATH)
-    except:
-        pass
-    with open(LOG_PATH, "w") as f:
-        f.write(get_date_and_time() + " [  OK  ] " + LOG_PREFIX + " Logging initialized.\n")
-
-def log(level: int, data: str):
-    if(level >= LOG_LEVEL):
-        output = get_date_and_time()
-        if(level == 0):
-            output += " [  OK  ] "
-        elif(level == 1):
-            output += " [ WARN ] "
-        else:
-            output += " [ERROR!] "
-        output += LOG_PREFIX + " "
-        output += data
-        if(LOG_TO_FILE):
-            with open(LOG_PATH, "a") as f:
-                f.write(output + "\n")
-        if(LOG_TO_CONSOLE):
-            print(output)
+# Configure logging for AP1200 and the AFSKmodem layer beneath it (level: a
+# logging level such as logging.INFO, console: write to stdout, path: log file
+# to create, or None). Both modules share one background log writer.
+def configure_logging(level = logging.WARNING, console = True, path = None):
+    afskmodem.configure_logging(level, console, path, names = ("ap1200", "afskmodem"))
 
 ################################################################################ General utilities
 class FormatUtils:
@@ -93,22 +61,45 @@ class FormatUtils:
 ################################################################################ Wrapper class for digital radio interface
 class RadioInterface: 
     def __init__(self):
-        self.receiver = afskmodem.DigitalReceiver(afskmodem.DigitalModulationTypes.afsk1200()) # see AFSKmodem README.md for more info on these
-        self.transmitter = afskmodem.DigitalTransmitter(afskmodem.DigitalModulationTypes.afsk1200())
+        self.receiver = None # Created on first use, see get_receiver() and get_transmitter()
+        self.transmitter = None
         self.integrity = 1
+        self.error_count = 0
+
+    def get_receiver(self) -> afskmodem.DigitalReceiver: # Return the receiver, creating it if needed
+        if(self.receiver is None):
+            self.receiver = afskmodem.DigitalReceiver(afskmodem.DigitalModulationTypes.afsk1200()) # see AFSKmodem README.md for more info on these
+        return self.receiver
+
+    def get_transmitter(self) -> afskmodem.DigitalTransmitter: # Return the transmitter, creating it if needed
+        if(self.transmitter is None):
+            self.transmitter = afskmodem.DigitalTransmitter(afskmodem.DigitalModulationTypes.afsk1200())
+        return self.transmitter
 
     def rx(self, timeout=-1) -> bytes: # Listen for and catch a transmission, report bit error rate and return data (bytes)
-        rd, te = self.receiver.rx(timeout)
-        if(len(rd) > 12): # Only record integrity for transmissions longer than 12 bytes (header is 16 bytes)
-            self.integrity = 1 - (te / len(rd))
+        rd, te = self.get_receiver().rx(timeout)
+        if(rd != b''): # Bit-level integrity from the soft-decision decoder
+            self.integrity = self.get_receiver().get_integrity()
+            self.error_count = te
         return rd
 
     def tx(self, data: bytes): # Transmit raw data (bytes)
-        self.transmitter.tx(data)
+        self.get_transmitter().tx(data)
 
     def get_integrity(self) -> float: # Return integrity of the last received transmission
         return self.integrity
 
+    def channel_busy(self) -> bool: # Carrier sense: return TRUE if another station is transmitting
+        return self.get_receiver().channel_busy()
+
+    def get_error_count(self) -> int: # Return the corrected error count of the last received transmission
+        return self.error_count
+
+    def get_last_recording(self) -> bytes: # Return the audio of the last received transmission
+        if(self.receiver is None):
+            return b''
+        return self.receiver.get_last_recording()
+
 ################################################################################ Packet structure and operations
 class Packet:
     def __init__(self, n_source = "", n_dest = "", n_port = 0, n_data = b''):
@@ -212,11 +203,13 @@ class Packet:
 
 ################################################################################ High-level operations
 class NetworkInterface:
-    def __init__(self, id: str, port: int):
+    def __init__(self, id: str, port: int, ri = None):
         self.id = id
         self.port = port
-        self.ri = RadioInterface()
-        log(0, "Instantiated a NetworkInterface for ID " + self.id + ". (" + str(self.port) + ")")
+        if(ri is None): # Any object with RadioInterface's methods can stand in, e.g. a simulated radio
+            ri = RadioInterface()
+        self.ri = ri
+        logger.info("Instantiated a NetworkInterface for ID %s. (%s)", self.id, self.port)
     
     # Return a Packet with the specified parameters
     def make_packet(self, dest: str, data: bytes) -> Packet:
@@ -224,32 +217,396 @@ class NetworkInterface:
     
     # Send a Packet
     def send_packet(self, p: Packet):
-        log(0, "Sending a Packet addressed to " + p.get_dest() + ". (" + str(p.get_port()) + ")")
+        if(logger.isEnabledFor(logging.INFO)):
+            logger.info("Sending a Packet addressed to %s. (%d)", p.get_dest(), p.get_port())
         self.ri.tx(p.save())
     
     # Listen for and return any Packet
     def listen_for_any_packet(self, timeout=-1) -> Packet: 
-        log(0, "Listening for any Packet...")
+        logger.info("Listening for any Packet...")
         while True:
             rd = self.ri.rx(timeout)
             if(rd != b''):
                 p = Packet()
                 p.load(rd)
-                log(0, "Caught a Packet addressed to " + p.get_dest() + ":" + str(p.get_port()) + ".")
+                if(logger.isEnabledFor(logging.INFO)):
+                    logger.info("Caught a Packet addressed to %s:%d.", p.get_dest(), p.get_port())
                 return p
     
     # Listen for and return a Packet addressed to this interface
     def listen_for_packet(self, timeout=-1) -> Packet: 
-        log(0, "Listening for a Packet addressed to this NetworkInterface (" + self.id + ":" + str(self.port) + ")...")
+        logger.info("Listening for a Packet addressed to this NetworkInterface (%s:%s)...", self.id, self.port)
         while True:
             rd = self.ri.rx(timeout)
             if(rd != b''):
                 p = Packet()
                 p.load(rd)
                 if(p.get_dest() == self.id and int(p.get_port()) == int(self.port)):
-                    log(0, "Received a Packet addressed to this NetworkInterface (" + self.id + ":" + str(self.port) + ").")
+                    logger.info("Received a Packet addressed to this NetworkInterface (%s:%s).", self.id, self.port)
                     return p
     
     # Get the integrity of the most recently received Packet
     def get_integrity(self) -> float: 
         return self.ri.get_integrity()
+
+    # Return TRUE if another station is transmitting (carrier sense)
+    def channel_busy(self) -> bool:
+        return self.ri.channel_busy()
+
+    # Get the corrected error count of the most recently received Packet
+    def get_error_count(self) -> int:
+        return self.ri.get_error_count()
+
+    # Get the recorded audio of the most recently received Packet
+    def get_last_recording(self) -> bytes:
+        return self.ri.get_last_recording()
+
+################################################################################ Channel access (CSMA)
+# Probability of transmitting in a slot when the channel is clear (0-1, Default 0.5)
+CSMA_PERSISTENCE = 0.5
+#
+# Slot time for persistence and backoff (seconds, Default 0.1)
+CSMA_SLOT_TIME = 0.1
+#
+# Largest backoff window after the channel was sensed busy (slots, Default 16)
+CSMA_MAX_BACKOFF_SLOTS = 16
+#
+# Maximum number of Packets waiting to be sent (Default 64)
+CSMA_MAX_QUEUE_DEPTH = 64
+
+class TransmitPriorities:
+    def ack() -> int: # Acknowledgements, sent before anything else
+        return 0
+    def high() -> int: # Time-sensitive traffic
+        return 1
+    def normal() -> int: # Default
+        return 2
+    def bulk() -> int: # Bulk data, sent when nothing else is waiting
+        return 3
+
+class TransmitScheduler:
+    # Queues Packets by priority (then in order) and sends them with
+    # p-persistent CSMA: the receiver's block amplitude detector is used as
+    # carrier sense. When the channel is clear the head Packet is sent with
+    # probability persistence, otherwise the scheduler waits one slot. When it
+    # is busy the scheduler backs off a random number of slots from a window
+    # that doubles with each consecutive busy sense. Random draws come from
+    # rng (a random.Random), or the random module if none is given.
+    def __init__(self, ni: NetworkInterface,
+    persistence = CSMA_PERSISTENCE,
+    slot_time = CSMA_SLOT_TIME,
+    max_backoff_slots = CSMA_MAX_BACKOFF_SLOTS,
+    max_queue_depth = CSMA_MAX_QUEUE_DEPTH,
+    rng = None):
+        self.ni = ni
+        if(rng is None):
+            rng = random
+        self.rng = rng
+        self.persistence = persistence
+        self.slot_time = slot_time
+        self.max_backoff_slots = max_backoff_slots
+        self.max_queue_depth = max_queue_depth
+        self.queue = [] # heap of (priority, sequence number, enqueue time, Packet)
+        self.sequence = 0
+        self.next_attempt = 0
+        self.busy_streak = 0
+        self.sent = 0
+        self.dropped = 0
+        self.busy_senses = 0
+        self.persistence_deferrals = 0
+        self.max_depth = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    # Queue a Packet. If the queue is full, the lowest priority (newest)
+    # queued Packet is dropped to make room if the new one outranks it,
+    # otherwise the new Packet is dropped and FALSE is returned.
+    def enqueue(self, p: Packet, priority = TransmitPriorities.normal(), now = None) -> bool:
+        if(now is None):
+            now = time.monotonic()
+        if(len(self.queue) >= self.max_queue_depth):
+            self.dropped += 1
+            if(not self.queue):
+                return False
+            worst = max(self.queue)
+            if(worst[0] <= priority):
+                return False
+            self.queue.remove(worst)
+            heapq.heapify(self.queue)
+        self.sequence += 1
+        heapq.heappush(self.queue, (priority, self.sequence, now, p))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        return True
+
+    # Make one channel access attempt if one is due. Returns the seconds until
+    # the next attempt (0 right after a Packet was sent), or -1 if the queue
+    # is empty.
+    def service(self, now = None) -> float:
+        if(now is None):
+            now = time.monotonic()
+        if(not self.queue):
+            return -1
+        if(now < self.next_attempt):
+            return self.next_attempt - now
+        if(self.ni.channel_busy()):
+            self.busy_senses += 1
+            self.busy_streak += 1
+            window = min(2 ** self.busy_streak, self.max_backoff_slots)
+            wait = self.rng.randint(1, window) * self.slot_time
+        elif(self.rng.random() < self.persistence):
+            priority, sequence, enqueue_time, p = heapq.heappop(self.queue)
+            waited = now - enqueue_time
+            self.ni.send_packet(p)
+            self.busy_streak = 0
+            self.sent += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            wait = 0
+        else:
+            self.persistence_deferrals += 1
+            wait = self.slot_time
+        self.next_attempt = now + wait
+        return wait
+
+    # Send queued Packets until the queue is empty or timeout seconds have
+    # passed (no timeout by default)
+    def run(self, timeout = -1):
+        end_time = time.monotonic() + timeout
+        while(timeout < 0 or time.monotonic() < end_time):
+            wait = self.service()
+            if(wait < 0):
+                return
+            if(wait > 0):
+                time.sleep(wait)
+
+    def get_queue_depth(self) -> int: # Number of Packets waiting
+        return len(self.queue)
+
+    # Queue, wait time and collision-avoidance counters
+    def get_stats(self) -> dict:
+        mean_wait = 0
+        if(self.sent > 0):
+            mean_wait = self.total_wait / self.sent
+        return {
+            "queue_depth": len(self.queue),
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "busy_senses": self.busy_senses,
+            "persistence_deferrals": self.persistence_deferrals,
+            "mean_wait": mean_wait,
+            "max_wait": self.max_wait,
+        }
+
+################################################################################ Digipeater (store-and-forward node)
+# How long a forwarded or heard frame is remembered for duplicate suppression (seconds, Default 30)
+DIGIPEATER_DUPLICATE_TTL = 30
+#
+# Maximum number of frame hashes remembered for duplicate suppression (Default 4096)
+DIGIPEATER_DUPLICATE_CACHE_SIZE = 4096
+#
+# Random delay before a frame is forwarded (seconds, Default 0.1-1.0). Spreads out
+# re-transmissions from digipeaters that heard the same frame.
+DIGIPEATER_MIN_DELAY = 0.1
+DIGIPEATER_MAX_DELAY = 1.0
+#
+# Maximum number of frames waiting to be forwarded (Default 32)
+DIGIPEATER_MAX_PENDING = 32
+#
+# Longest time to listen before checking for due forwards (seconds, Default 1.0)
+DIGIPEATER_LISTEN_TIMEOUT = 1.0
+
+class SeenFrameCache:
+    # Bounded, time-expiring set of recently seen frame hashes.
+    def __init__(self, ttl = DIGIPEATER_DUPLICATE_TTL, max_entries = DIGIPEATER_DUPLICATE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # hash -> expiry time, oldest first
+
+    # Hash identifying a frame
+    def get_hash(frame: bytes) -> bytes:
+        return hashlib.blake2b(frame, digest_size = 8).digest()
+
+    # Drop expired entries
+    def __expire(self, now: float):
+        while(self.entries):
+            frame_hash, expiry = next(iter(self.entries.items()))
+            if(expiry > now):
+                break
+            del self.entries[frame_hash]
+
+    # Return TRUE if the hash was seen within the last ttl seconds
+    def contains(self, frame_hash: bytes, now: float) -> bool:
+        self.__expire(now)
+        return frame_hash in self.entries
+
+    # Remember a hash for ttl seconds from now, evicting the oldest if full
+    def add(self, frame_hash: bytes, now: float):
+        self.__expire(now)
+        if(frame_hash in self.entries):
+            del self.entries[frame_hash]
+        self.entries[frame_hash] = now + self.ttl
+        while(len(self.entries) > self.max_entries):
+            self.entries.popitem(last = False)
+
+    def get_size(self) -> int: # Number of hashes currently remembered
+        return len(self.entries)
+
+class RoutingTable:
+    # Destinations a digipeater forwards frames for. A route matches a
+    # destination ID and either one port or any port (-1). The ID "*" matches
+    # any destination.
+    def __init__(self):
+        self.routes = {} # dest ID -> set of ports
+
+    # Forward frames addressed to dest (on the given port, or any port)
+    def add_route(self, dest: str, port = -1):
+        self.routes.setdefault(dest, set()).add(int(port))
+
+    # Stop forwarding frames addressed to dest (on the given port, or all ports)
+    def remove_route(self, dest: str, port = -1):
+        if(dest not in self.routes):
+            return
+        if(port == -1):
+            del self.routes[dest]
+        else:
+            self.routes[dest].discard(int(port))
+            if(not self.routes[dest]):
+                del self.routes[dest]
+
+    # Return TRUE if a Packet should be forwarded
+    def matches(self, p: Packet) -> bool:
+        for dest in (p.get_dest(), "*"):
+            ports = self.routes.get(dest)
+            if(ports is not None and (-1 in ports or p.get_port() in ports)):
+                return True
+        return False
+
+class Digipeater:
+    # Store-and-forward repeater on top of a NetworkInterface. Frames whose
+    # destination matches the routing table are re-transmitted unchanged after
+    # a random delay. Frames already forwarded or heard within the duplicate
+    # TTL are dropped, and a pending forward is cancelled if another station
+    # repeats the same frame first.
+    def __init__(self, ni: NetworkInterface, routes: RoutingTable,
+    min_delay = DIGIPEATER_MIN_DELAY,
+    max_delay = DIGIPEATER_MAX_DELAY,
+    max_pending = DIGIPEATER_MAX_PENDING,
+    seen = None,
+    start_time = None):
+        self.ni = ni
+        self.routes = routes
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        if(seen is None):
+            seen = SeenFrameCache()
+        self.seen = seen
+        self.pending = [] # heap of (due time, sequence number, frame hash)
+        self.pending_frames = {} # frame hash -> Packet
+        self.sequence = 0
+        self.start_time = start_time # Rates are measured from here (the first time seen by default)
+        self.received = 0
+        self.forwarded = 0
+        self.dropped_duplicate = 0
+        self.dropped_invalid = 0
+        self.dropped_no_route = 0
+        self.dropped_queue_full = 0
+        logger.info("Digipeater running on NetworkInterface %s.", self.ni.id)
+
+    # The given time, or the monotonic clock if it is None. Times may be
+    # injected (e.g. by a simulation), so the first one seen starts the clock.
+    def __get_time(self, now) -> float:
+        if(now is None):
+            now = time.monotonic()
+        if(self.start_time is None):
+            self.start_time = now
+        return now
+
+    # Handle a received frame: schedule it for forwarding or drop it.
+    # Returns TRUE if the frame was scheduled.
+    def handle_frame(self, frame: bytes, now = None) -> bool:
+        now = self.__get_time(now)
+        self.received += 1
+        # Drop frames too short for a header or shorter than their length field
+        if(len(frame) < 20 or 20 + FormatUtils.bytes_to_int(frame[18:20]) > len(frame)):
+            self.dropped_invalid += 1
+            return False
+        p = Packet()
+        p.load(frame)
+        frame_hash = SeenFrameCache.get_hash(p.save())
+        if(frame_hash in self.pending_frames): # Someone else repeated it first
+            del self.pending_frames[frame_hash]
+            self.seen.add(frame_hash, now)
+            self.dropped_duplicate += 1
+            return False
+        if(self.seen.contains(frame_hash, now)):
+            self.dropped_duplicate += 1
+            return False
+        self.seen.add(frame_hash, now)
+        if(not self.routes.matches(p)):
+            self.dropped_no_route += 1
+            return False
+        if(len(self.pending_frames) >= self.max_pending):
+            self.dropped_queue_full += 1
+            return False
+        due = now + random.uniform(self.min_delay, self.max_delay)
+        self.sequence += 1
+        heapq.heappush(self.pending, (due, self.sequence, frame_hash))
+        self.pending_frames[frame_hash] = p
+        return True
+
+    # Forward every frame that is due. Returns the seconds until the next
+    # forward is due, or -1 if nothing is pending.
+    def service(self, now = None) -> float:
+        use_clock = now is None
+        now = self.__get_time(now)
+        while(self.pending):
+            due, sequence, frame_hash = self.pending[0]
+            p = self.pending_frames.get(frame_hash)
+            if(p is None): # Cancelled
+                heapq.heappop(self.pending)
+                continue
+            if(due > now):
+                return due - now
+            heapq.heappop(self.pending)
+            del self.pending_frames[frame_hash]
+            self.ni.send_packet(p)
+            if(use_clock): # Sending takes a while on a real radio
+                now = time.monotonic()
+            self.seen.add(frame_hash, now)
+            self.forwarded += 1
+        return -1
+
+    # Listen and forward until duration seconds have passed (forever by default)
+    def run(self, duration = -1):
+        end_time = time.monotonic() + duration
+        while(duration < 0 or time.monotonic() < end_time):
+            wait = self.service()
+            if(wait < 0 or wait > DIGIPEATER_LISTEN_TIMEOUT):
+                wait = DIGIPEATER_LISTEN_TIMEOUT
+            if(duration >= 0):
+                wait = min(wait, max(end_time - time.monotonic(), 0))
+            # Listen for at least one input block
+            wait = max(wait, afskmodem.INPUT_FRAMES_PER_BLOCK / afskmodem.SAMPLE_RATE)
+            rd = self.ni.ri.rx(wait)
+            if(rd != b''):
+                self.handle_frame(rd)
+
+    # Counters and rates (per second since the digipeater started)
+    def get_stats(self, now = None) -> dict:
+        now = self.__get_time(now)
+        elapsed = max(now - self.start_time, 1e-9)
+        dropped = self.dropped_duplicate + self.dropped_invalid + self.dropped_no_route + self.dropped_queue_full
+        return {
+            "received": self.received,
+            "forwarded": self.forwarded,
+            "dropped_duplicate": self.dropped_duplicate,
+            "dropped_invalid": self.dropped_invalid,
+            "dropped_no_route": self.dropped_no_route,
+            "dropped_queue_full": self.dropped_queue_full,
+            "pending": len(self.pending_frames),
+            "seen_cache_size": self.seen.get_size(),
+            "forward_rate": self.forwarded / elapsed,
+            "drop_rate": dropped / elapsed,
+        }
@@ -0,0 +1,241 @@
+import afskmodem
+import ap1200
+import argparse
+import mmap
+import struct
+import time
+from datetime import datetime
+"""
+x-----------------------------------------------------------x
+| AP1200 capture - Indexed packet capture log and replay    |
+| https://github.com/lavajuno/ap1200                        |
+x-----------------------------------------------------------x
+"""
+################################################################################ CAPTURE FORMAT
+# A capture is two append-only files:
+#   <name>.dat  Header, then each record's frame bytes followed by its audio
+#   <name>.idx  Header, then one fixed-size index entry per record
+# Index entries are written after their data, so a crash can at worst leave
+# unindexed data behind. Timestamps never decrease, so time ranges can be
+# found by binary search.
+#
+# File headers (magic + format version)
+DATA_MAGIC = b"AP1CAPD\x01"
+INDEX_MAGIC = b"AP1CAPI\x01"
+#
+# Index entry: timestamp, data offset, source ID, dest ID, port, flag,
+# integrity, error count, frame length, audio length
+INDEX_ENTRY = struct.Struct("<dQ8s8sBBfIII")
+
+################################################################################ Records
+class CaptureRecord:
+    def __init__(self, timestamp: float, source: bytes, dest: bytes, port: int, flag: int,
+    integrity: float, error_count: int, frame: bytes, audio: bytes):
+        self.timestamp = timestamp
+        self.source = source
+        self.dest = dest
+        self.port = port
+        self.flag = flag
+        self.integrity = integrity
+        self.error_count = error_count
+        self.frame = frame
+        self.audio = audio
+
+    # Get the captured frame as a Packet
+    def get_packet(self) -> ap1200.Packet:
+        p = ap1200.Packet()
+        p.load(self.frame)
+        return p
+
+    # One-line summary of this record
+    def describe(self) -> str:
+        return "{} {} -> {} ({}) [F: {}, L: {}, I: {:.2f}%, E: {}{}]".format(
+            datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            ap1200.FormatUtils.decode_id(self.source), ap1200.FormatUtils.decode_id(self.dest),
+            self.port, self.flag, len(self.frame), self.integrity * 100, self.error_count,
+            ", audio" if self.audio else "")
+
+################################################################################ Writing
+class CaptureWriter:
+    # Appends records to a capture, creating it if it does not exist.
+    def __init__(self, name: str):
+        self.data_file = open(name + ".dat", "ab")
+        self.index_file = open(name + ".idx", "ab")
+        if(self.data_file.tell() == 0):
+            self.data_file.write(DATA_MAGIC)
+        if(self.index_file.tell() < len(INDEX_MAGIC)):
+            self.index_file.truncate(0)
+            self.index_file.write(INDEX_MAGIC)
+        # Drop a partially written trailing entry so new entries stay aligned
+        count = (self.index_file.tell() - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+        index_size = len(INDEX_MAGIC) + count * INDEX_ENTRY.size
+        if(self.index_file.tell() != index_size):
+            self.index_file.truncate(index_size)
+        self.last_timestamp = 0.0
+        if(count > 0): # Continue after the last entry
+            with open(name + ".idx", "rb") as f:
+                f.seek(index_size - INDEX_ENTRY.size)
+                self.last_timestamp = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+
+    # Append a Packet with its reception details (and optionally its audio)
+    def write(self, p: ap1200.Packet, integrity = 1.0, error_count = 0, audio = b"", timestamp = None):
+        if(timestamp is None):
+            timestamp = time.time()
+        timestamp = max(timestamp, self.last_timestamp)
+        frame = p.save()
+        offset = self.data_file.tell()
+        self.data_file.write(frame)
+        self.data_file.write(audio)
+        self.data_file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(timestamp, offset, p.src_id, p.dest_id,
+            p.get_port(), p.get_flag(), integrity, error_count, len(frame), len(audio)))
+        self.index_file.flush()
+        self.last_timestamp = timestamp
+
+    # Append the Packet most recently received by a NetworkInterface
+    def write_received(self, ni: ap1200.NetworkInterface, p: ap1200.Packet, include_audio = False):
+        audio = b""
+        if(include_audio):
+            audio = ni.get_last_recording()
+        self.write(p, ni.get_integrity(), ni.get_error_count(), audio)
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+
+################################################################################ Reading
+class CaptureReader:
+    # Memory-maps a capture for queries. Records appended after the reader
+    # was opened are not visible until it is opened again.
+    def __init__(self, name: str):
+        self.data_file = open(name + ".dat", "rb")
+        self.index_file = open(name + ".idx", "rb")
+        if(self.data_file.read(len(DATA_MAGIC)) != DATA_MAGIC or self.index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC):
+            self.close()
+            raise ValueError(name + " is not an AP1200 capture")
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        # Ignore a partially written trailing entry
+        self.count = (len(self.index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+
+    def get_count(self) -> int: # Number of records
+        return self.count
+
+    # Get the timestamp of record i
+    def __get_timestamp(self, i: int) -> float:
+        return struct.unpack_from("<d", self.index, len(INDEX_MAGIC) + i * INDEX_ENTRY.size)[0]
+
+    # First record index with a timestamp >= t
+    def __find_time(self, t: float) -> int:
+        lo = 0
+        hi = self.count
+        while(lo < hi):
+            mid = (lo + hi) // 2
+            if(self.__get_timestamp(mid) < t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Get record i
+    def get_record(self, i: int) -> CaptureRecord:
+        if(i < 0 or i >= self.count):
+            raise IndexError("capture record index out of range")
+        (timestamp, offset, source, dest, port, flag, integrity, error_count,
+            frame_len, audio_len) = INDEX_ENTRY.unpack_from(self.index, len(INDEX_MAGIC) + i * INDEX_ENTRY.size)
+        frame = self.data[offset:offset+frame_len]
+        audio = self.data[offset+frame_len:offset+frame_len+audio_len]
+        return CaptureRecord(timestamp, source, dest, port, flag, integrity, error_count, frame, audio)
+
+    # Return the indexes of records matching every given filter (source and
+    # dest IDs, port, and a start/end time range in seconds since the epoch).
+    # Only the index is scanned; time ranges are found by binary search.
+    def query(self, source = None, dest = None, port = None, start = None, end = None) -> list:
+        first = 0
+        last = self.count
+        if(start is not None):
+            first = self.__find_time(start)
+        if(end is not None):
+            last = self.__find_time(end)
+        if(first >= last):
+            return []
+        if(source is not None):
+            source = ap1200.FormatUtils.encode_id(source)
+        if(dest is not None):
+            dest = ap1200.FormatUtils.encode_id(dest)
+        entries = memoryview(self.index)[len(INDEX_MAGIC) + first * INDEX_ENTRY.size:len(INDEX_MAGIC) + last * INDEX_ENTRY.size]
+        matches = []
+        i = first
+        for entry in INDEX_ENTRY.iter_unpack(entries):
+            if((source is None or entry[2] == source) and (dest is None or entry[3] == dest)
+                and (port is None or entry[4] == port)):
+                matches.append(i)
+            i += 1
+        entries.release()
+        return matches
+
+    def close(self):
+        if(hasattr(self, "data")):
+            self.data.close()
+            self.index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+################################################################################ Replay
+# Feed captured records back through the modem as fast as the CPU allows.
+# Records with audio are decoded by the DigitalReceiver; frames without audio
+# are rendered by the DigitalTransmitter first. Yields (record index, record,
+# decoded Packet, TRUE if the decoded frame matches the captured one).
+def replay(reader: CaptureReader, indexes = None, frames_only = False,
+    digital_modulation_type = afskmodem.DigitalModulationTypes.afsk1200()):
+    receiver = afskmodem.DigitalReceiver(digital_modulation_type)
+    transmitter = afskmodem.DigitalTransmitter(digital_modulation_type, tx_cache = afskmodem.TXAudioCache(0))
+    if(indexes is None):
+        indexes = range(reader.get_count())
+    for i in indexes:
+        record = reader.get_record(i)
+        audio = record.audio
+        if(frames_only or not audio):
+            audio = transmitter.encode(record.frame)
+        rd, error_count = receiver.decode(audio)
+        p = ap1200.Packet()
+        p.load(rd)
+        yield i, record, p, p.save() == record.frame
+
+################################################################################ Command line
+def main():
+    parser = argparse.ArgumentParser(description = "Query and replay AP1200 packet captures.")
+    parser.add_argument("command", choices = ("query", "replay"))
+    parser.add_argument("capture", help = "capture name (without .dat/.idx)")
+    parser.add_argument("--source", help = "only records from this ID")
+    parser.add_argument("--dest", help = "only records addressed to this ID")
+    parser.add_argument("--port", type = int, help = "only records on this port")
+    parser.add_argument("--start", type = float, help = "only records at or after this UNIX time")
+    parser.add_argument("--end", type = float, help = "only records before this UNIX time")
+    parser.add_argument("--frames-only", action = "store_true", help = "replay: re-render frames even if audio was captured")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.capture)
+    t = time.perf_counter()
+    indexes = reader.query(args.source, args.dest, args.port, args.start, args.end)
+    query_time = time.perf_counter() - t
+    if(args.command == "query"):
+        for i in indexes:
+            print(reader.get_record(i).describe())
+        print(str(len(indexes)) + " of " + str(reader.get_count()) + " records matched ("
+            + "{:.3f}".format(query_time * 1000) + " ms).")
+    else:
+        matched = 0
+        t = time.perf_counter()
+        for i, record, p, ok in replay(reader, indexes, args.frames_only):
+            if(ok):
+                matched += 1
+            else:
+                print("MISMATCH " + str(i) + ": " + record.describe())
+        elapsed = time.perf_counter() - t
+        print("Replayed " + str(len(indexes)) + " records in " + "{:.2f}".format(elapsed) + " s: "
+            + str(matched) + " matched, " + str(len(indexes) - matched) + " mismatched.")
+    reader.close()
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,447 @@
+import afskmodem
+import ap1200
+import argparse
+import heapq
+import json
+import logging
+import math
+import random
+import struct
+import time
+"""
+x-----------------------------------------------------------x
+| AP1200 sim - In-process multi-node network simulator      |
+| https://github.com/lavajuno/ap1200                        |
+x-----------------------------------------------------------x
+"""
+################################################################################ PROGRAM DEFAULTS
+# Scenario values used when a scenario file does not set them.
+#
+# Simulated time in seconds
+SIM_DURATION = 600
+#
+# Link SNR in dB (Eb/N0) for node pairs without an explicit link
+SIM_DEFAULT_SNR = 28
+#
+# Lowest SNR at which a station can hear (and carrier-sense) another one, in dB
+SIM_MIN_SNR = 3
+#
+# Propagation speed used with node positions (km/s)
+SIM_PROPAGATION_SPEED = 300000
+#
+# Time a station must hear a transmission before carrier sense reports it, in
+# seconds (Default one input block, as DigitalReceiver.channel_busy() reads)
+SIM_SENSE_TIME = afskmodem.INPUT_FRAMES_PER_BLOCK / afskmodem.SAMPLE_RATE
+#
+# Delay from deciding to transmit until the signal is on the air, in seconds
+# (Default one output block)
+SIM_TX_DELAY = afskmodem.OUTPUT_FRAMES_PER_BLOCK / afskmodem.SAMPLE_RATE
+#
+# Decode model: "fast" (analytic bit error model) or "modem" (render, add
+# noise and decode every frame with afskmodem)
+SIM_DECODE_MODEL = "fast"
+#
+# How much worse than ideal non-coherent FSK the modem performs, in dB. The fast
+# model subtracts this from the link SNR so both models agree (measured with
+# the modem model at afsk1200)
+SIM_IMPLEMENTATION_LOSS = 8
+
+################################################################################ Simulated radio
+class SimulatedRadio:
+    # Stands in for RadioInterface inside a NetworkInterface. Transmissions
+    # go onto the shared VirtualMedium; frames the medium delivers are queued
+    # until the NetworkInterface listens for them.
+    def __init__(self, medium, node_id: str):
+        self.medium = medium
+        self.node_id = node_id
+        self.inbox = []
+        self.integrity = 1
+        self.error_count = 0
+        self.transmitting_until = 0
+
+    def tx(self, data: bytes): # Start a transmission at the current simulated time
+        self.medium.transmit(self, data)
+
+    def rx(self, timeout=-1) -> bytes: # Return the next delivered frame (b'' if there is none)
+        if(not self.inbox):
+            return b''
+        data, self.integrity, self.error_count = self.inbox.pop(0)
+        return data
+
+    def channel_busy(self) -> bool: # Carrier sense on the virtual medium
+        return self.medium.channel_busy(self)
+
+    def deliver(self, data: bytes, integrity: float, error_count: int): # Called by the medium
+        self.inbox.append((data, integrity, error_count))
+
+    def get_integrity(self) -> float:
+        return self.integrity
+
+    def get_error_count(self) -> int:
+        return self.error_count
+
+    def get_last_recording(self) -> bytes:
+        return b''
+
+################################################################################ Decode models
+class FastDecodeModel:
+    # Analytic model: bit error rate of non-coherent FSK at the link's Eb/N0
+    # less the modem's implementation loss, and a frame survives if no 12-bit
+    # Hamming codeword has 2+ bit errors.
+    def __init__(self, implementation_loss = SIM_IMPLEMENTATION_LOSS):
+        self.implementation_loss = implementation_loss
+
+    def decode(self, frame: bytes, snr: float, rng: random.Random):
+        ebn0 = 10 ** ((snr - self.implementation_loss) / 10)
+        ber = 0.5 * math.exp(-ebn0 / 2)
+        codeword_ok = (1 - ber) ** 12 + 12 * ber * (1 - ber) ** 11
+        if(rng.random() < codeword_ok ** len(frame)):
+            return frame, 1 - ber, 0
+        return b'', 0, 0
+
+class ModemDecodeModel:
+    # Real modem path: render the frame with DigitalTransmitter, add white
+    # Gaussian noise for the link's Eb/N0 and decode it with DigitalReceiver.
+    # The silence pads stand for the squelched receiver and stay noise free.
+    def __init__(self, digital_modulation_type = afskmodem.DigitalModulationTypes.afsk1200()):
+        # Every simulated frame is unique (it carries a serial), so caching
+        # rendered audio would only cost time
+        self.transmitter = afskmodem.DigitalTransmitter(digital_modulation_type, tx_cache = afskmodem.TXAudioCache(0))
+        self.receiver = afskmodem.DigitalReceiver(digital_modulation_type)
+        self.samples_per_bit = afskmodem.DigitalModulationTypes.get_unit_time(digital_modulation_type)
+        self.cpu_time = 0
+
+    def decode(self, frame: bytes, snr: float, rng: random.Random):
+        t = time.process_time()
+        wav_data = self.transmitter.encode(frame)
+        n_frames = len(wav_data) // 2
+        samples = list(struct.unpack("<" + str(n_frames) + "h", wav_data))
+        pad = len(self.transmitter.tx_silence) // 2
+        # Eb/N0 = (signal power * samples per bit) / (2 * noise variance)
+        signal_power = sum(v * v for v in samples[pad:n_frames - pad]) / (n_frames - 2 * pad)
+        sigma = math.sqrt(signal_power * self.samples_per_bit / (2 * 10 ** (snr / 10)))
+        for i in range(pad, n_frames - pad):
+            samples[i] = max(-32768, min(32767, int(samples[i] + rng.gauss(0, sigma))))
+        data, error_count = self.receiver.decode(struct.pack("<" + str(n_frames) + "h", *samples))
+        self.cpu_time += time.process_time() - t
+        return data, self.receiver.get_integrity(), error_count
+
+################################################################################ Virtual medium
+class Transmission:
+    def __init__(self, source: SimulatedRadio, frame: bytes, start: float, end: float):
+        self.source = source
+        self.frame = frame
+        self.start = start
+        self.end = end
+
+class VirtualMedium:
+    # Shared channel between SimulatedRadios. Each transmission arrives at its
+    # addressed station (if that can hear it) after the link's propagation
+    # delay; it is lost there if any other audible transmission overlaps it
+    # (no capture effect) or the station was transmitting itself (half
+    # duplex). Bystanders only see it through carrier sense, so losses are
+    # counted once per Packet. Carrier
+    # sense only notices a transmission sense_time after it starts arriving,
+    # and a transmission goes on the air tx_delay after it is started.
+    def __init__(self, sim, decode_model, min_snr = SIM_MIN_SNR,
+    digital_modulation_type = afskmodem.DigitalModulationTypes.afsk1200(),
+    sense_time = SIM_SENSE_TIME, tx_delay = SIM_TX_DELAY):
+        self.sim = sim
+        self.decode_model = decode_model
+        self.min_snr = min_snr
+        self.sense_time = sense_time
+        self.tx_delay = tx_delay
+        self.radios = []
+        self.links = {} # (radio a, radio b) -> (snr, delay)
+        self.active = [] # recent transmissions, oldest first
+        self.timing = afskmodem.DigitalTransmitter(digital_modulation_type)
+        self.longest_airtime = 0
+        self.longest_delay = 0
+        self.airtime = 0
+        self.lost_collision = 0
+        self.lost_noise = 0
+
+    def add_radio(self, radio: SimulatedRadio):
+        self.radios.append(radio)
+
+    def set_link(self, a: SimulatedRadio, b: SimulatedRadio, snr: float, delay: float):
+        self.links[(a, b)] = (snr, delay)
+        self.links[(b, a)] = (snr, delay)
+        self.longest_delay = max(self.longest_delay, delay)
+
+    # Link (snr, delay) if b can hear a, else None
+    def get_link(self, a: SimulatedRadio, b: SimulatedRadio):
+        link = self.links.get((a, b))
+        if(link is None or link[0] < self.min_snr):
+            return None
+        return link
+
+    def transmit(self, source: SimulatedRadio, frame: bytes):
+        start = self.sim.now + self.tx_delay
+        end = start + self.timing.est_tx_time(len(frame))
+        tx = Transmission(source, frame, start, end)
+        source.transmitting_until = end
+        self.active.append(tx)
+        self.airtime += end - start
+        self.longest_airtime = max(self.longest_airtime, end - start)
+        dest = ap1200.FormatUtils.decode_id(frame[8:16])
+        for radio in self.radios:
+            link = self.get_link(source, radio)
+            if(radio is not source and radio.node_id == dest and link is not None):
+                self.sim.schedule(end + link[1], self.__arrive, tx, radio)
+        self.sim.schedule(end, self.sim.node_transmit_done, source)
+
+    # Drop transmissions that can no longer overlap anything still arriving
+    def __prune(self, now: float):
+        horizon = now - self.longest_airtime - 2 * self.longest_delay
+        while(self.active and self.active[0].end < horizon):
+            self.active.pop(0)
+
+    # A transmission has fully arrived at a radio
+    def __arrive(self, tx: Transmission, radio: SimulatedRadio):
+        snr, delay = self.get_link(tx.source, radio)
+        start = tx.start + delay
+        end = tx.end + delay
+        for other in self.active:
+            if(other is tx):
+                continue
+            if(other.source is radio): # Half duplex: we were keyed up
+                overlaps = other.start < end and other.end > start
+            else:
+                link = self.get_link(other.source, radio)
+                overlaps = link is not None and other.start + link[1] < end and other.end + link[1] > start
+            if(overlaps):
+                self.lost_collision += 1
+                self.__prune(self.sim.now)
+                return
+        data, integrity, error_count = self.decode_model.decode(tx.frame, snr, self.sim.rng)
+        if(data != tx.frame): # Lost or corrupted (the modem model can return either)
+            self.lost_noise += 1
+        else:
+            radio.deliver(data, integrity, error_count)
+            self.sim.node_received(radio)
+        self.__prune(self.sim.now)
+
+    # Carrier sense: has an audible transmission been arriving at the radio
+    # for at least sense_time?
+    def channel_busy(self, radio: SimulatedRadio) -> bool:
+        now = self.sim.now
+        for tx in self.active:
+            if(tx.source is radio):
+                continue
+            link = self.get_link(tx.source, radio)
+            if(link is not None and tx.start + link[1] + self.sense_time <= now < tx.end + link[1]):
+                return True
+        return False
+
+################################################################################ Simulation
+class SimNode:
+    def __init__(self, sim, spec: dict, csma: dict):
+        self.radio = SimulatedRadio(sim.medium, spec["id"])
+        self.ni = ap1200.NetworkInterface(spec["id"], spec.get("port", 0), ri = self.radio)
+        self.scheduler = ap1200.TransmitScheduler(self.ni, rng = sim.rng, **csma)
+        self.x = spec.get("x", 0) # Position in km
+        self.y = spec.get("y", 0)
+        self.service_pending = False
+
+class Simulation:
+    # Discrete-event simulation of many NetworkInterfaces (each with its own
+    # TransmitScheduler) sharing a VirtualMedium, driven by a scenario dict.
+    def __init__(self, scenario: dict):
+        self.scenario = scenario
+        self.rng = random.Random(scenario.get("seed", 1))
+        self.now = 0
+        self.duration = scenario.get("duration", SIM_DURATION)
+        self.events = [] # heap of (time, sequence number, function, arguments)
+        self.sequence = 0
+        modulation = scenario.get("modulation", afskmodem.DigitalModulationTypes.afsk1200())
+        model = scenario.get("decode_model", SIM_DECODE_MODEL)
+        if(model == "modem"):
+            self.decode_model = ModemDecodeModel(modulation)
+        elif(model == "fast"):
+            self.decode_model = FastDecodeModel()
+        else:
+            raise ValueError("unknown decode model: " + str(model))
+        self.medium = VirtualMedium(self, self.decode_model, scenario.get("min_snr", SIM_MIN_SNR), modulation,
+            scenario.get("sense_time", SIM_SENSE_TIME), scenario.get("tx_delay", SIM_TX_DELAY))
+        self.nodes = {}
+        self.packets = {} # serial -> (created time, dest ID, payload size)
+        self.offered = 0
+        self.queue_drops = 0
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.latencies = []
+        self.__build()
+
+    # Create nodes, links and traffic sources from the scenario
+    def __build(self):
+        sc = self.scenario
+        csma = sc.get("csma", {})
+        node_specs = sc.get("nodes")
+        if(node_specs is None):
+            node_specs = [{"id": "N" + str(i)} for i in range(sc.get("node_count", 2))]
+        for spec in node_specs:
+            node = SimNode(self, spec, csma)
+            self.nodes[spec["id"]] = node
+            self.medium.add_radio(node.radio)
+        explicit = {}
+        for link in sc.get("links", []):
+            explicit[(link["a"], link["b"])] = link
+            explicit[(link["b"], link["a"])] = link
+        speed = sc.get("propagation_speed", SIM_PROPAGATION_SPEED)
+        ids = list(self.nodes)
+        for i in range(len(ids)):
+            for j in range(i + 1, len(ids)):
+                a = self.nodes[ids[i]]
+                b = self.nodes[ids[j]]
+                link = explicit.get((ids[i], ids[j]), {})
+                snr = link.get("snr", sc.get("default_snr", SIM_DEFAULT_SNR))
+                if(snr is None): # Explicitly out of range
+                    continue
+                delay = link.get("delay", math.hypot(a.x - b.x, a.y - b.y) / speed)
+                self.medium.set_link(a.radio, b.radio, snr, delay)
+        for flow in sc.get("traffic", []):
+            sources = ids if flow.get("source", "*") == "*" else [flow["source"]]
+            for source in sources:
+                self.schedule(self.rng.expovariate(flow["rate"]), self.__generate, source, flow)
+
+    def schedule(self, at: float, function, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, function, args))
+
+    # Make sure a node's scheduler gets serviced now
+    def __wake(self, node: SimNode):
+        if(not node.service_pending and node.radio.transmitting_until <= self.now):
+            node.service_pending = True
+            self.schedule(self.now, self.__service, node)
+
+    def __service(self, node: SimNode):
+        node.service_pending = False
+        wait = node.scheduler.service(self.now)
+        if(wait > 0):
+            node.service_pending = True
+            self.schedule(self.now + wait, self.__service, node)
+        # wait == 0: transmitting, node_transmit_done wakes the node again
+
+    def node_transmit_done(self, radio: SimulatedRadio):
+        self.__wake(self.nodes[radio.node_id])
+
+    # A node's radio has a frame waiting: let its NetworkInterface read it
+    def node_received(self, radio: SimulatedRadio):
+        node = self.nodes[radio.node_id]
+        p = node.ni.listen_for_any_packet()
+        if(p.get_dest() != node.ni.id or len(p.get_data()) < 4):
+            return
+        serial = struct.unpack(">I", p.get_data()[0:4])[0]
+        info = self.packets.pop(serial, None)
+        if(info is None or info[1] != node.ni.id): # Unknown or already delivered
+            return
+        self.delivered += 1
+        self.delivered_bytes += info[2]
+        self.latencies.append(self.now - info[0])
+
+    # Traffic source: queue a Packet and schedule the next one
+    def __generate(self, source: str, flow: dict):
+        if(self.now >= self.duration):
+            return
+        node = self.nodes[source]
+        dest = flow.get("dest", "*")
+        if(dest == "*"):
+            dest = self.rng.choice([i for i in self.nodes if i != source])
+        size = max(4, flow.get("size", 32))
+        serial = self.offered
+        self.offered += 1
+        data = struct.pack(">I", serial) + bytes(size - 4)
+        priority = getattr(ap1200.TransmitPriorities, flow.get("priority", "normal"))()
+        if(node.scheduler.enqueue(node.ni.make_packet(dest, data), priority, self.now)):
+            self.packets[serial] = (self.now, dest, size)
+            self.__wake(node)
+        else:
+            self.queue_drops += 1
+        self.schedule(self.now + self.rng.expovariate(flow["rate"]), self.__generate, source, flow)
+
+    # Run to the end of the scenario and return the results
+    def run(self) -> dict:
+        t = time.perf_counter()
+        while(self.events and self.events[0][0] <= self.duration):
+            self.now, sequence, function, args = heapq.heappop(self.events)
+            function(*args)
+        self.now = self.duration
+        return self.get_results(time.perf_counter() - t)
+
+    # Nearest-rank percentile of a sorted list
+    def __percentile(self, values: list, pct: float) -> float:
+        if(not values):
+            return 0
+        return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+    def get_results(self, wall_time = 0) -> dict:
+        latencies = sorted(self.latencies)
+        csma = {"busy_senses": 0, "persistence_deferrals": 0, "sent": 0}
+        for node in self.nodes.values():
+            stats = node.scheduler.get_stats()
+            for key in csma:
+                csma[key] += stats[key]
+        results = {
+            "nodes": len(self.nodes),
+            "duration": self.duration,
+            "offered": self.offered,
+            "sent": csma["sent"],
+            "delivered": self.delivered,
+            "delivery_ratio": self.delivered / self.offered if self.offered else 0,
+            "goodput_bps": self.delivered_bytes * 8 / self.duration,
+            "channel_utilization": self.medium.airtime / self.duration,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else 0,
+            "latency_p50": self.__percentile(latencies, 50),
+            "latency_p90": self.__percentile(latencies, 90),
+            "latency_p99": self.__percentile(latencies, 99),
+            "lost_collision": self.medium.lost_collision,
+            "lost_noise": self.medium.lost_noise,
+            "queue_drops": self.queue_drops,
+            "busy_senses": csma["busy_senses"],
+            "persistence_deferrals": csma["persistence_deferrals"],
+            "wall_time": wall_time,
+        }
+        if(isinstance(self.decode_model, ModemDecodeModel)):
+            results["modem_cpu_time"] = self.decode_model.cpu_time
+        return results
+
+################################################################################ Command line
+def main():
+    parser = argparse.ArgumentParser(description = "Simulate an AP1200 network from a scenario file.")
+    parser.add_argument("scenario", help = "scenario file (JSON)")
+    parser.add_argument("--model", choices = ("fast", "modem"), help = "override the scenario's decode model")
+    parser.add_argument("--nodes", type = int, nargs = "+", help = "override node_count; several values run a sweep")
+    parser.add_argument("--duration", type = float, help = "override the simulated time in seconds")
+    parser.add_argument("--json", action = "store_true", help = "print results as JSON")
+    args = parser.parse_args()
+
+    logging.getLogger("afskmodem").setLevel(logging.ERROR) # Lost frames are expected here
+    with open(args.scenario) as f:
+        scenario = json.load(f)
+    if(args.model is not None):
+        scenario["decode_model"] = args.model
+    if(args.duration is not None):
+        scenario["duration"] = args.duration
+    counts = [None]
+    if(args.nodes is not None):
+        counts = args.nodes
+    all_results = []
+    for count in counts:
+        if(count is not None):
+            scenario["node_count"] = count
+            scenario.pop("nodes", None)
+        results = Simulation(scenario).run()
+        all_results.append(results)
+        if(not args.json):
+            print("{nodes} nodes, {duration:g} s: offered {offered}, delivered {delivered} "
+                "({delivery_ratio:.1%}), goodput {goodput_bps:.1f} bit/s, utilization {channel_utilization:.1%}".format(**results))
+            print("  latency mean {latency_mean:.2f} s, p50 {latency_p50:.2f} s, p90 {latency_p90:.2f} s, "
+                "p99 {latency_p99:.2f} s".format(**results))
+            print("  lost: {lost_collision} collisions, {lost_noise} noise, {queue_drops} queue drops; "
+                "CSMA: {busy_senses} busy senses, {persistence_deferrals} deferrals".format(**results))
+    if(args.json):
+        print(json.dumps(all_results, indent = 2))
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,99 @@
+import logging
+import random
+import struct
+import sys
+import afskmodem
+
+# Modem regression checks: render frames, degrade the audio and check that the
+# receiver still decodes them. Exits with status 1 if any check fails.
+SEED = 1
+FRAME_SIZE = 64
+RUNS = 6
+IMPULSE_FRAME_SIZE = 200
+IMPULSE_RATE = 0.002 # Chance of an impulse starting at each sample
+IMPULSE_LENGTH = 20 # Samples (half an afsk1200 symbol)
+SINGLE_BIT_TRIALS = 2000
+SINGLE_BIT_MIN_CORRECT = 0.95
+
+# Render random frames, scale them down and add white Gaussian noise (sigma)
+def make_noisy_frames(digital_modulation_type: str, scale: float, sigma: float, rng: random.Random) -> list:
+    transmitter = afskmodem.DigitalTransmitter(digital_modulation_type, tx_cache = afskmodem.TXAudioCache(0))
+    frames = []
+    for i in range(RUNS):
+        data = bytes(rng.randrange(256) for j in range(FRAME_SIZE))
+        wav_data = transmitter.encode(data)
+        n_frames = len(wav_data) // 2
+        samples = struct.unpack("<" + str(n_frames) + "h", wav_data)
+        noisy = [max(-32768, min(32767, int(v * scale + rng.gauss(0, sigma)))) for v in samples]
+        frames.append((data, struct.pack("<" + str(n_frames) + "h", *noisy)))
+    return frames
+
+# Weak, noisy audio must decode as well with decimation as without it
+def check_decimation(digital_modulation_type: str, scale: float, sigma: float, rng: random.Random) -> bool:
+    frames = make_noisy_frames(digital_modulation_type, scale, sigma, rng)
+    decoded = {}
+    for decimate in (True, False):
+        receiver = afskmodem.DigitalReceiver(digital_modulation_type, decimate = decimate)
+        decoded[decimate] = sum(receiver.decode(wav_data)[0] == data for data, wav_data in frames)
+    ok = decoded[True] >= decoded[False] and decoded[False] == RUNS
+    print("{:<44} decimated {}/{}, full rate {}/{}   {}".format(
+        "decimation {} x{} sigma {}".format(digital_modulation_type, scale, sigma),
+        decoded[True], RUNS, decoded[False], RUNS, "ok" if ok else "FAIL"))
+    return ok
+
+# Soft-decision decoding must fix more bytes than hard decoding when short
+# full-scale impulses hit the data part of a frame
+def check_chase_impulses(digital_modulation_type: str, rng: random.Random) -> bool:
+    transmitter = afskmodem.DigitalTransmitter(digital_modulation_type, tx_cache = afskmodem.TXAudioCache(0))
+    data = bytes(rng.randrange(256) for j in range(IMPULSE_FRAME_SIZE))
+    wav_data = transmitter.encode(data)
+    n_frames = len(wav_data) // 2
+    samples = list(struct.unpack("<" + str(n_frames) + "h", wav_data))
+    pad = len(transmitter.tx_silence) // 2
+    i = pad + (transmitter.ts_oscillations * 2 + 4) * transmitter.unit_time # Spare the training block
+    while(i < n_frames - pad - IMPULSE_LENGTH):
+        if(rng.random() < IMPULSE_RATE):
+            samples[i:i + IMPULSE_LENGTH] = [rng.choice((-32767, 32767))] * IMPULSE_LENGTH
+            i += IMPULSE_LENGTH
+        i += 1
+    wav_data = struct.pack("<" + str(n_frames) + "h", *samples)
+    receiver = afskmodem.DigitalReceiver(digital_modulation_type)
+    byte_errors = {}
+    for chase_depth in (0, afskmodem.CHASE_DEPTH):
+        receiver.ecc = afskmodem.Hamming(chase_depth)
+        decoded = receiver.decode(wav_data)[0]
+        byte_errors[chase_depth] = sum(a != b for a, b in zip(decoded, data)) + abs(len(decoded) - len(data))
+    ok = byte_errors[afskmodem.CHASE_DEPTH] < byte_errors[0]
+    print("{:<44} soft {} bad bytes, hard {} bad bytes   {}".format(
+        "chase impulses " + digital_modulation_type, byte_errors[afskmodem.CHASE_DEPTH], byte_errors[0], "ok" if ok else "FAIL"))
+    return ok
+
+# Single-bit errors with reliabilities that carry no information must still
+# (nearly always) get the hard-decision correction
+def check_chase_single_bit(rng: random.Random) -> bool:
+    hard = afskmodem.Hamming(0)
+    soft = afskmodem.Hamming()
+    correct = 0
+    for i in range(SINGLE_BIT_TRIALS):
+        byte = "{0:08b}".format(rng.randrange(256))
+        codeword = list(hard.encode(byte))
+        error = rng.randrange(len(codeword))
+        codeword[error] = "1" if codeword[error] == "0" else "0"
+        if(soft.decode_soft("".join(codeword), [rng.random() for j in codeword]) == byte):
+            correct += 1
+    ok = correct >= SINGLE_BIT_MIN_CORRECT * SINGLE_BIT_TRIALS
+    print("{:<44} {:.1%} corrected   {}".format("chase single-bit, random reliabilities",
+        correct / SINGLE_BIT_TRIALS, "ok" if ok else "FAIL"))
+    return ok
+
+logging.getLogger("afskmodem").setLevel(logging.CRITICAL) # Failed decodes are expected here
+rng = random.Random(SEED)
+results = [
+    check_decimation(afskmodem.DigitalModulationTypes.afsk300(), 0.6, 6000, rng),
+    check_decimation(afskmodem.DigitalModulationTypes.afsk1200(), 0.6, 6000, rng),
+    check_decimation(afskmodem.DigitalModulationTypes.afsk1200(), 1.0, 18000, rng),
+    check_chase_impulses(afskmodem.DigitalModulationTypes.afsk1200(), rng),
+    check_chase_single_bit(rng),
+]
+if(not all(results)):
+    sys.exit(1)
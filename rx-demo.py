@@ -1,4 +1,8 @@
-from ap1200 import NetworkInterface
+import logging
+from ap1200 import NetworkInterface, configure_logging
+from ap1200capture import CaptureWriter
+
+configure_logging(logging.INFO)
 
 print("AP1200 RX Demo")
 print("Homepage: https://github.com/lavajuno/ap1200/")
@@ -13,6 +17,11 @@ else:
     print("Enter port to listen on (0-255)")
     this_port = input(":")
     ni = NetworkInterface(this_addr, this_port)
+print("Enter capture name to log packets and audio to (BLANK:NONE)")
+capture_name = input(":")
+capture = None
+if(capture_name != ""):
+    capture = CaptureWriter(capture_name)
 
 while(True):
     print("Listening for packet...\n")
@@ -29,6 +38,8 @@ while(True):
     p_length = p.get_length()
     p_data = p.get_data()
     p_integrity = round(ni.get_integrity() * 100, 4)
+    if(capture is not None):
+        capture.write_received(ni, p, include_audio = True)
 
     # display attributes
     print("\nPacket received (Integrity: " + str(p_integrity) + "%)")
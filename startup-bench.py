@@ -0,0 +1,52 @@
+import statistics
+import subprocess
+import sys
+
+# Startup benchmark: cold import time of afskmodem/ap1200 and first-packet
+# latency (import, NetworkInterface, render one Packet and decode it again).
+# Every sample runs in a fresh interpreter so nothing is cached between runs.
+RUNS = 10
+
+IMPORT_AFSKMODEM = """
+import time
+t = time.perf_counter()
+import afskmodem
+print(time.perf_counter() - t)
+"""
+
+IMPORT_AP1200 = """
+import time
+t = time.perf_counter()
+import ap1200
+print(time.perf_counter() - t)
+"""
+
+FIRST_PACKET = """
+import time
+t = time.perf_counter()
+import ap1200
+ni = ap1200.NetworkInterface("BENCH", 1)
+p = ni.make_packet("DEST", b"startup benchmark")
+wav_data = ni.ri.get_transmitter().encode(p.save())
+rendered = time.perf_counter() - t
+data, errors = ni.ri.get_receiver().decode(wav_data)
+assert data == p.save()
+print(rendered, time.perf_counter() - t)
+"""
+
+# Run a snippet in a fresh interpreter and return the numbers it prints
+def run_snippet(code: str) -> list:
+    out = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True)
+    return [float(v) for v in out.stdout.split()]
+
+def report(name: str, samples: list):
+    ms = [v * 1000 for v in samples]
+    print("{:<28} median {:8.2f} ms   min {:8.2f} ms   max {:8.2f} ms".format(
+        name, statistics.median(ms), min(ms), max(ms)))
+
+print("AP1200 startup benchmark (" + str(RUNS) + " runs each)")
+report("import afskmodem", [run_snippet(IMPORT_AFSKMODEM)[0] for i in range(RUNS)])
+report("import ap1200", [run_snippet(IMPORT_AP1200)[0] for i in range(RUNS)])
+first = [run_snippet(FIRST_PACKET) for i in range(RUNS)]
+report("first packet rendered", [v[0] for v in first])
+report("first packet decoded", [v[1] for v in first])
@@ -1,4 +1,7 @@
-from ap1200 import NetworkInterface
+import logging
+from ap1200 import NetworkInterface, configure_logging
+
+configure_logging(logging.INFO)
 
 print("ap1200 TX Demo")
 print("Homepage: https://github.com/lavajuno/ap1200/")